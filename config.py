@@ -14,3 +14,10 @@ class OCR:
     MODEL = "1909"
     # what page segmentation mode to use
     PSM = "6"
+    # the mode for OCRing a single row strip at a time (raw_ocr --rows)
+    ROW_PSM = "7"
+
+
+# every stage appends a json line of its timings and counters here. Set
+# TELEMETRY in the environment to use another file, or to "" for none
+TELEMETRY_FILE = BASE_DIR / "working" / "telemetry.jsonl"
@@ -8,13 +8,25 @@ import peakutils
 from loguru import logger
 from PIL import Image
 
-from image_utils import deskew, get_histogram
+import page_transform
+import telemetry
+from image_utils import (
+    DESKEW_METHODS,
+    ROTATE_BACKENDS,
+    BinaryImage,
+    deskew_angle,
+    get_histogram,
+)
+from page_transform import Transform
 
 # sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 
 logger.remove()
 
+# part of the stage cache key: bump it when the crop output changes
+STAGE_VERSION = 3
+
 
 def find_top_two_lines(img):
     """Each page has two horizontal lines running across the top"""
@@ -27,46 +39,48 @@ def find_top_two_lines(img):
     return indexes[-1]
 
 
-def topline_crop(img: Image):
+def topline_crop(img: BinaryImage, transform: Transform = None):
 
     topline = find_top_two_lines(img)
 
     wd, ht = img.size
+    box = (0, topline, wd, ht)
+    if transform is not None:
+        transform.crop(box)
 
-    return img.crop((0, topline, wd, ht))
+    return img.crop(box)
 
 
-@click.command()
-@click.argument("filename", type=click.Path(exists=True))
-@click.argument("output", type=click.Path())
-@click.option(
-    "--force",
-    is_flag=True,
-    help="Force auto-cropping even if the override file exists.",
-)
-def crop_page(filename, output, force):
-    """deskew using horizontal lines and intelligently crop
+def rotate(
+    im: BinaryImage, angle, transform: Transform = None, backend="scipy"
+) -> BinaryImage:
+    if transform is not None:
+        transform.rotate(angle)
+    return im.rotate(angle, backend)
 
-    unless page-handcrop.png exists, in which case copy that."""
 
-    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+def crop_image(
+    im: BinaryImage,
+    filename="",
+    deskew_method="rotate",
+    transform=None,
+    deskew_backend="scipy",
+) -> BinaryImage:
+    """deskew using horizontal lines and intelligently crop
 
-    handcrop = pathlib.Path(filename).with_name("page-handcrop.png")
-    if handcrop.exists() and not force:
-        shutil.copy(handcrop, output)
-        logger.success(
-            "%s: page-handcrop.png exists, using it to override.\n" % (filename,)
-        )
+    Each rotation and crop is also added to transform, if one is given."""
 
-        sys.exit()
+    def find_angle(im, axis):
+        return deskew_angle(im, axis=axis, method=deskew_method, backend=deskew_backend)
 
-    im = Image.open(filename)
-    # pix = im.load()
     width, height = im.size
     logger.info("%s: %dx%d\n" % (filename, width, height))
     logger.info("%s: deskewing horiz " % (filename,))
 
-    im = deskew(im)
+    im = rotate(im, find_angle(im, 0), transform, deskew_backend)
+    if deskew_method == "lines":
+        # the rules are measured before they're cropped off
+        vertical = find_angle(im, 1)
 
     width, height = im.size
     logger.info("(%dx%d)\n" % (width, height))
@@ -74,21 +88,98 @@ def crop_page(filename, output, force):
     try:
         logger.debug("%s: removing top two lines.\n" % (filename,))
 
-        im = topline_crop(im)
-    except:
-        logger.critical("%s: failed to find the top two lines.\n" % (filename,))
-        sys.exit(1)
+        im = topline_crop(im, transform)
+    except Exception:
+        raise RuntimeError("%s: failed to find the top two lines." % (filename,))
     width, height = im.size
 
     logger.info("%s: deskewing vert\n" % (filename,))
-    im = deskew(im, axis=1)
+    if deskew_method != "lines":
+        vertical = find_angle(im, 1)
+    im = rotate(im, vertical, transform, deskew_backend)
     width, height = im.size
 
     # sys.stderr.write("%s: cropping\n" % (filename,))
     # im = newish_crop(im)
     # width, height = im.size
     logger.info("%s: revised to %dx%d\n" % (filename, width, height))
-    im.save(output)
+    return im
+
+
+def auto_crop_page(
+    filename, output, force=False, deskew_method="rotate", deskew_backend="scipy"
+):
+    """deskew and crop filename into output
+
+    unless page-handcrop.png exists, in which case copy that.
+
+    How the crop was cut from filename goes in the page's manifest (see
+    page_transform), for split_columns to cut the columns from filename
+    in one go."""
+
+    filename, output = pathlib.Path(filename), pathlib.Path(output)
+    # the manifest is the page directory's, so only for crops kept there
+    record = filename.parent == output.parent
+    with telemetry.stage("crop_page", page=telemetry.page_of(filename)):
+        handcrop = filename.with_name("page-handcrop.png")
+        if handcrop.exists() and not force:
+            shutil.copy(handcrop, output)
+            telemetry.note(handcrop=True)
+            logger.success(
+                "%s: page-handcrop.png exists, using it to override.\n" % (filename,)
+            )
+            if record:
+                with Image.open(handcrop) as img:
+                    page_transform.record_crop(
+                        output.parent, handcrop, Transform(img.size)
+                    )
+            return
+
+        page = BinaryImage.open(filename)
+        telemetry.note(width=page.size[0], height=page.size[1])
+        transform = Transform(page.size)
+        crop_image(page, filename, deskew_method, transform, deskew_backend)
+        # the crop is cut from the page in one resample, as a replay of the
+        # manifest cuts it, rather than kept from rotating it twice in turn
+        im = transform.apply(page)
+        telemetry.note(crop_width=im.size[0], crop_height=im.size[1])
+        im.save(output)
+        if record:
+            page_transform.record_crop(output.parent, filename, transform)
+
+
+@click.command()
+@click.argument("filename", type=click.Path(exists=True))
+@click.argument("output", type=click.Path())
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Force auto-cropping even if the override file exists.",
+)
+@click.option(
+    "--deskew-method",
+    type=click.Choice(DESKEW_METHODS),
+    default="rotate",
+    help="How to find deskew angles: rotate, projection or lines.",
+)
+@click.option(
+    "--deskew-backend",
+    type=click.Choice(sorted(ROTATE_BACKENDS)),
+    default="scipy",
+    help="What rotates the image, while searching and once the angle is found.",
+)
+def crop_page(filename, output, force, deskew_method, deskew_backend):
+    """deskew using horizontal lines and intelligently crop
+
+    unless page-handcrop.png exists, in which case copy that."""
+
+    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+
+    try:
+        auto_crop_page(filename, output, force, deskew_method, deskew_backend)
+    except RuntimeError as e:
+        logger.critical("{}\n", e)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
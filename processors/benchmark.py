@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+import contextlib
+import importlib.util
+import io
+import json
+import pathlib
+import platform
+import random
+import shutil
+import sys
+import time
+import tracemalloc
+
+import click
+import numpy as np
+import pandas as pd
+from loguru import logger
+from PIL import Image, ImageDraw, ImageFont
+
+import telemetry
+from image_utils import as_binary, deskew, find_max_square, max_square_crop
+from ocr_column import handle_data
+from slip_index import slip_index
+from street_correct import divide_into_rows, divide_slip, find_five_columns
+from word_table import WORD_COLUMNS, word_frame
+
+# the size of a scanned page at 600 dpi, give or take
+PAGE_SIZE = (4000, 5400)
+
+# slower (or bigger) than the baseline by this factor counts as a regression
+TOLERANCE = 1.2
+
+# ...as long as it's also this many seconds slower, the quick ones are noisy
+SLACK = 0.01
+
+
+def load_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # older pillow only has the one small bitmap font
+        return ImageFont.load_default()
+
+
+def render_page(size=1.0, skew=0.0, noise=0.0, seed=0):
+    """Draw a directory page: two rules across the top, five columns split by
+    four thick bars, street names between runs of odd/even new/old pairs
+
+    size scales the page, not the type, which stays the size it is at 600 dpi.
+
+    Returns the page, and the words drawn on each column as
+    column-N-raw_ocr.csv would have them (in column coordinates)."""
+
+    rnd = random.Random(seed)
+    width, height = int(PAGE_SIZE[0] * size), int(PAGE_SIZE[1] * size)
+    page = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(page)
+    font = load_font(34)
+    street_font = load_font(44)
+    row_height = 48
+
+    margin = width // 20
+    top = height // 12
+    rule = 8
+    draw.rectangle((margin, top, width - margin, top + rule), fill=0)
+    draw.rectangle((margin, top + 4 * rule, width - margin, top + 5 * rule), fill=0)
+
+    column_width = (width - 2 * margin) / 5
+    bars = [int(margin + i * column_width) for i in range(6)]
+    bar = 6
+    for x in bars[1:-1]:
+        draw.rectangle((x - bar, top + 5 * rule, x + bar, height - margin), fill=0)
+
+    columns = []
+    for c in range(5):
+        left = bars[c] + bar
+        words = []
+
+        def write(text, x, y, line, drawn_font=font):
+            draw.text((x, y), text, fill=0, font=drawn_font)
+            l, t, r, b = draw.textbbox((x, y), text, font=drawn_font)
+            words.append((text, line, l - left, t, r - left, b))
+
+        y = top + 80
+        number = rnd.randrange(100, 3000, 2)
+        line = 0
+        while y < height - margin - 2 * row_height:
+            line += 1
+            x = left + 20
+            if rnd.random() < 0.05:
+                name = "{} {}".format(
+                    rnd.choice(["Foo", "Bar", "Elm", "Oak"]),
+                    rnd.choice(["Street", "Avenue", "Court"]),
+                )
+                for i, word in enumerate(name.split()):
+                    write(
+                        word,
+                        x + 40 + i * 160,
+                        y,
+                        line,
+                        street_font,
+                    )
+                y += 70
+                number = rnd.randrange(100, 3000, 2)
+                continue
+            # odd new/old pair on the left, even on the right
+            for i, text in enumerate(
+                [number + 1, rnd.randrange(1, 3000), number, rnd.randrange(1, 3000)]
+            ):
+                write(str(text), x + int(i * column_width / 4), y, line)
+            number += 2
+            y += row_height
+        columns.append(word_table(words))
+
+    if noise:
+        pixels = np.asarray(page).copy()
+        speckles = int(width * height * noise)
+        pixels[
+            [rnd.randrange(height) for _ in range(speckles)],
+            [rnd.randrange(width) for _ in range(speckles)],
+        ] = 0
+        page = Image.fromarray(pixels)
+    if skew:
+        page = page.rotate(skew, fillcolor=255)
+    return page.point(lambda p: 255 if p > 127 else 0), columns
+
+
+def word_table(words) -> pd.DataFrame:
+    """Drawn words as a raw ocr word table"""
+    rnd = random.Random(len(words))
+    rows = []
+    for word_num, (text, line, left, top, right, bot) in enumerate(words, 1):
+        rows.append(
+            {
+                "level": 5,
+                "page_num": 1,
+                "block_num": 1,
+                "par_num": 1,
+                "line_num": line,
+                "word_num": word_num,
+                "left": left,
+                "top": top,
+                "width": right - left,
+                "height": bot - top,
+                "conf": round(rnd.uniform(80, 99), 6),
+                "text": text,
+                "right": right,
+                "bot": bot,
+            }
+        )
+    return word_frame(pd.DataFrame(rows, columns=list(WORD_COLUMNS)))
+
+
+def column_image(page):
+    """The first column of an unskewed page, as split_columns would cut it"""
+    bars = find_five_columns(as_binary(page))
+    left, right = bars[0]
+    return page.crop((left, 0, right, page.size[1]))
+
+
+def tesseract_available():
+    return bool(importlib.util.find_spec("tesserocr") or shutil.which("tesseract"))
+
+
+def benchmarks(page, skewed, columns, ocr=False):
+    """(name, function, units of work, unit name) for one page, and a skewed
+    copy of it for deskew to straighten"""
+
+    bits = as_binary(page)
+    skewed_bits = as_binary(skewed)
+    megapixels = page.size[0] * page.size[1] / 1e6
+    column = column_image(page)
+    column_megapixels = column.size[0] * column.size[1] / 1e6
+    rows = list(divide_into_rows(as_binary(column)))
+    white = (~bits.bits).view(np.uint8)
+
+    def deskew_rotate():
+        deskew(skewed_bits, method="rotate")
+
+    def deskew_cv2():
+        deskew(skewed_bits, method="rotate", backend="cv2")
+
+    def deskew_projection():
+        deskew(skewed_bits, method="projection")
+
+    def deskew_lines():
+        deskew(skewed_bits, method="lines")
+
+    def divide_slips():
+        for row in rows:
+            divide_slip(column.crop(row))
+
+    def parse():
+        for table in columns:
+            handle_data(table.copy(), "bench", None, None, True)
+
+    tests = [
+        ("deskew[rotate]", deskew_rotate, megapixels, "Mpx"),
+        ("deskew[rotate/cv2]", deskew_cv2, megapixels, "Mpx"),
+        ("deskew[projection]", deskew_projection, megapixels, "Mpx"),
+        ("deskew[lines]", deskew_lines, megapixels, "Mpx"),
+        ("find_max_square", lambda: find_max_square(white), megapixels, "Mpx"),
+        ("max_square_crop", lambda: max_square_crop(page), megapixels, "Mpx"),
+        ("find_five_columns", lambda: find_five_columns(bits), megapixels, "Mpx"),
+        (
+            "divide_into_rows",
+            lambda: list(divide_into_rows(as_binary(column))),
+            column_megapixels,
+            "Mpx",
+        ),
+        ("divide_slip", divide_slips, len(rows), "rows"),
+        ("slip_index", lambda: slip_index(column), column_megapixels, "Mpx"),
+        ("handle_data", parse, sum(len(x) for x in columns), "words"),
+    ]
+    if ocr:
+        from raw_ocr import prepare_ocr_data
+
+        tests.append(
+            (
+                "prepare_ocr_data",
+                lambda: prepare_ocr_data(column),
+                column_megapixels,
+                "Mpx",
+            )
+        )
+    return tests
+
+
+def measure(func, repeat):
+    """Best and mean wall time over repeat runs, then peak traced memory
+    over one more (tracing slows things down, so it isn't timed)"""
+
+    # some stages print their warnings, which would bury the results
+    quiet = io.StringIO()
+    with contextlib.redirect_stdout(quiet), contextlib.redirect_stderr(quiet):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return min(times), sum(times) / len(times), peak / (1 << 20)
+
+
+def run_benchmarks(sizes, repeat=3, skew=0.3, noise=0.0005, only=None) -> dict:
+    results = {}
+    ocr = tesseract_available()
+    if not ocr:
+        logger.warning("no tesseract, skipping prepare_ocr_data")
+    for size in sizes:
+        # find_five_columns wants bars with clean edges, as a handcrop has
+        page, columns = render_page(size)
+        skewed, _ = render_page(size, skew, noise)
+        for name, func, units, unit in benchmarks(page, skewed, columns, ocr):
+            if only and not any(x in name for x in only):
+                continue
+            best, mean, peak = measure(func, repeat)
+            key = "{}@{}".format(name, size)
+            results[key] = {
+                "best": best,
+                "mean": mean,
+                "peak_mb": peak,
+                "throughput": units / best if best else None,
+                "unit": "{}/s".format(unit),
+            }
+            print(
+                "{:<28} {:8.3f}s best {:8.3f}s mean {:8.1f}MB {:10.2f} {}/s".format(
+                    key, best, mean, peak, units / best if best else 0, unit
+                )
+            )
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE) -> list:
+    """The benchmarks that got slower or bigger than the baseline by more
+    than tolerance"""
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None:
+            print("{:<28} new".format(key))
+            continue
+        time_ratio = result["best"] / before["best"] if before["best"] else 1
+        memory_ratio = result["peak_mb"] / before["peak_mb"] if before["peak_mb"] else 1
+        slower = time_ratio > tolerance and result["best"] - before["best"] > SLACK
+        regressed = slower or memory_ratio > tolerance
+        print(
+            "{:<28} {:5.2f}x time {:5.2f}x memory{}".format(
+                key,
+                time_ratio,
+                memory_ratio,
+                "  REGRESSION" if regressed else "",
+            )
+        )
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--sizes",
+    default="0.5,1",
+    help="Page sizes to run at, as multiples of a 600 dpi page.",
+)
+@click.option("--repeat", type=int, default=3, help="Timed runs of each benchmark.")
+@click.option(
+    "--only", multiple=True, help="Just the benchmarks whose name contains this."
+)
+@click.option(
+    "--save",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    help="Write the results here, as the baseline for later runs.",
+)
+@click.option(
+    "--compare",
+    "baseline_file",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    help="Compare against this baseline, failing on any regression.",
+)
+@click.option(
+    "--tolerance",
+    type=float,
+    default=TOLERANCE,
+    help="How many times slower or bigger than the baseline is a regression.",
+)
+def benchmark(sizes, repeat, only, save, baseline_file, tolerance):
+    """Time the imaging and parsing stages on synthetic pages"""
+
+    # only warnings, the stages' own logging would drown out the timings
+    logger.add(sys.stderr, format="<level>{message}</level>", level="WARNING")
+    # the benchmark's stages aren't the book's
+    telemetry.configure(enabled=False)
+
+    results = run_benchmarks(
+        [float(x) for x in sizes.split(",")], repeat, only=only or None
+    )
+
+    if save:
+        save.write_text(
+            json.dumps(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "processor": platform.processor(),
+                    "results": results,
+                },
+                indent=1,
+                sort_keys=True,
+            )
+        )
+
+    if baseline_file:
+        baseline = json.loads(baseline_file.read_text())["results"]
+        regressions = compare(results, baseline, tolerance)
+        if regressions:
+            logger.error("{} regressions: {}", len(regressions), ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logger.remove()
+
+    benchmark()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import csv
+import json
+import pathlib
+import shutil
+import sys
+
+import click
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from loguru import logger
+
+from ocr_column import COLUMNS
+from stage_cache import file_digest
+
+# bump this when the page store's layout changes
+STAGE_VERSION = 1
+
+PAGE_FILE = "page.parquet"
+
+# the book's record of which version of each page it holds. The leading
+# underscore keeps the dataset reader from taking it for data
+MANIFEST = "_manifest.json"
+
+# the columns of page.csv, which the csv export reproduces
+CSV_COLUMNS = [
+    "page",
+    "column",
+    "line_num",
+    "street",
+    "new",
+    "old",
+    "new_conf",
+    "old_conf",
+    "new_bbox",
+    "old_bbox",
+    "flag",
+]
+
+BBOX_EDGES = ["left", "top", "right", "bot"]
+
+# page.csv, with each bbox as four integer columns
+SCHEMA = pa.schema(
+    [
+        ("page", pa.int32()),
+        ("column", pa.int8()),
+        ("line_num", pa.int32()),
+        ("street", pa.string()),
+        ("new", pa.string()),
+        ("old", pa.string()),
+        ("new_conf", pa.float64()),
+        ("old_conf", pa.float64()),
+    ]
+    + [("new_" + edge, pa.int32()) for edge in BBOX_EDGES]
+    + [("old_" + edge, pa.int32()) for edge in BBOX_EDGES]
+    + [("flag", pa.bool_())]
+)
+
+# the book is partitioned into a directory per page. Each page's file has a
+# row group per column, so reading one column skips the rest of the page
+# without paying for a file per column
+PARTITIONING = ds.partitioning(pa.schema([("page", pa.int32())]), flavor="hive")
+
+
+def stack_csvs(inputs, output):
+    """Concatenate csv files that share a header, like csvstack"""
+    with open(output, "w", newline="") as output_fp:
+        writer = csv.writer(output_fp)
+        header = None
+        for filename in inputs:
+            with open(filename, newline="") as input_fp:
+                reader = csv.reader(input_fp)
+                this_header = next(reader, None)
+                if header is None:
+                    header = this_header
+                    writer.writerow(header)
+                writer.writerows(reader)
+
+
+def split_bboxes(data: pd.DataFrame) -> pd.DataFrame:
+    """Replace the "(left, top, right, bot)" new_bbox/old_bbox strings
+    with four integer columns each"""
+    for side in ("new", "old"):
+        edges = data[side + "_bbox"].str.extract(
+            r"\(\s*(-?[0-9.]+),\s*(-?[0-9.]+),\s*(-?[0-9.]+),\s*(-?[0-9.]+)\s*\)"
+        )
+        for i, edge in enumerate(BBOX_EDGES):
+            data[side + "_" + edge] = edges[i].astype(float).astype("int32")
+    return data.drop(columns=["new_bbox", "old_bbox"])
+
+
+def read_ocr_csv(filename) -> pd.DataFrame:
+    """Read a column-N-ocr.csv (or page.csv) into the store's columns"""
+    data = pd.read_csv(
+        filename,
+        dtype={
+            "street": str,
+            "new": str,
+            "old": str,
+            "new_bbox": str,
+            "old_bbox": str,
+        },
+    )
+    data = split_bboxes(data)
+    return typed(data)
+
+
+def typed(data: pd.DataFrame) -> pd.DataFrame:
+    """Put data into the store's column order and types"""
+    return pa.Table.from_pandas(
+        data[SCHEMA.names], schema=SCHEMA, preserve_index=False
+    ).to_pandas()
+
+
+def page_table(page_dir: pathlib.Path, columns=COLUMNS) -> pd.DataFrame:
+    """A page's column-N-ocr.csv files, as one typed table"""
+    return pd.concat(
+        [read_ocr_csv(page_dir / "column-{}-ocr.csv".format(i)) for i in columns],
+        ignore_index=True,
+    )
+
+
+def write_store(data: pd.DataFrame, output: pathlib.Path):
+    """Write addresses to a parquet file, a row group per column"""
+    # dot-named, so a half-written partition isn't read as part of the book
+    tmp = output.with_name("." + output.name + ".tmp")
+    with pq.ParquetWriter(tmp, SCHEMA) as writer:
+        if data.empty:
+            writer.write_table(SCHEMA.empty_table())
+        for column, column_data in data.groupby("column", sort=False):
+            writer.write_table(
+                pa.Table.from_pandas(column_data, schema=SCHEMA, preserve_index=False)
+            )
+    tmp.replace(output)
+
+
+def write_page(page_dir: pathlib.Path, columns=COLUMNS):
+    """Write page.parquet from the page's column outputs, and page.csv
+    alongside it for anything that still reads csv"""
+
+    ocrs = [page_dir / "column-{}-ocr.csv".format(i) for i in columns]
+    write_store(page_table(page_dir, columns), page_dir / PAGE_FILE)
+    stack_csvs(ocrs, page_dir / "page.csv")
+
+
+def load_page(page_dir: pathlib.Path, columns=None) -> pd.DataFrame:
+    """A page's addresses, from page.parquet, or from page.csv if the page
+    was built before there was a store"""
+    store = page_dir / PAGE_FILE
+    if store.exists():
+        return pd.read_parquet(store, columns=columns)
+    data = read_ocr_csv(page_dir / "page.csv")
+    return data if columns is None else data[columns]
+
+
+def partition(book_dir: pathlib.Path, page_dir: pathlib.Path) -> pathlib.Path:
+    return book_dir / "page={}".format(int(page_dir.name)) / "part-0.parquet"
+
+
+def page_source(page_dir: pathlib.Path):
+    """The file a page's partition is made from, if the page has one"""
+    for source in (page_dir / PAGE_FILE, page_dir / "page.csv"):
+        if source.exists():
+            return source
+    return None
+
+
+def fingerprint(source: pathlib.Path, known=None) -> dict:
+    """Identify the content of a page's source file. The hash is only
+    recomputed when the file's size or modification time changed."""
+    stat = source.stat()
+    current = {
+        "file": source.name,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if known and all(known.get(k) == v for k, v in current.items()):
+        return known
+    current["sha256"] = file_digest(source)
+    return current
+
+
+def write_partition(book_dir: pathlib.Path, page_dir: pathlib.Path, source):
+    output = partition(book_dir, page_dir)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    if source.name == PAGE_FILE:
+        # already laid out the way the book wants it
+        tmp = output.with_name("." + output.name + ".tmp")
+        shutil.copyfile(source, tmp)
+        tmp.replace(output)
+    else:
+        # built before there was a store
+        write_store(load_page(page_dir), output)
+
+
+def update_book(book_dir: pathlib.Path, page_dirs, rebuild=False) -> list:
+    """Bring the book up to date with page_dirs, which are all of its pages
+
+    Each page's fingerprint is kept in the book's manifest, and only the
+    partitions of pages whose page.parquet (or page.csv) changed are written
+    again; pages that have gone are removed. Returns the names of the pages
+    that were written."""
+
+    manifest_file = book_dir / MANIFEST
+    if rebuild:
+        shutil.rmtree(book_dir, ignore_errors=True)
+    try:
+        manifest = json.loads(manifest_file.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+
+    book_dir.mkdir(parents=True, exist_ok=True)
+    pages = {}
+    written = []
+    for page_dir in page_dirs:
+        if not page_dir.name.isdigit():
+            continue
+        source = page_source(page_dir)
+        if source is None:
+            continue
+        known = manifest.get(page_dir.name)
+        pages[page_dir.name] = fingerprint(source, known)
+        if (
+            known is None
+            or known.get("sha256") != pages[page_dir.name]["sha256"]
+            or not partition(book_dir, page_dir).exists()
+        ):
+            write_partition(book_dir, page_dir, source)
+            written.append(page_dir.name)
+
+    for name in manifest.keys() - pages.keys():
+        shutil.rmtree(
+            partition(book_dir, pathlib.Path(name)).parent, ignore_errors=True
+        )
+
+    tmp = manifest_file.with_name("." + manifest_file.name + ".tmp")
+    tmp.write_text(json.dumps(pages, indent=1, sort_keys=True))
+    tmp.replace(manifest_file)
+
+    logger.info(
+        "{}: {} pages, {} written, {} removed",
+        book_dir,
+        len(pages),
+        len(written),
+        len(manifest.keys() - pages.keys()),
+    )
+    return written
+
+
+def load_book(book_dir: pathlib.Path, columns=None, pages=None) -> pd.DataFrame:
+    """The book's addresses, in page, column and line order
+
+    pages limits it to those page numbers, reading only their partitions"""
+    dataset = ds.dataset(book_dir, format="parquet", partitioning=PARTITIONING)
+    table = dataset.to_table(
+        columns=columns,
+        filter=None if pages is None else ds.field("page").isin(list(pages)),
+    )
+    data = table.to_pandas()
+    if "page" in data.columns:
+        # partitions come back in path order, page=10 before page=2
+        data = data.sort_values("page", kind="stable", ignore_index=True)
+    return data
+
+
+def export_csv(data: pd.DataFrame, output):
+    """Write addresses out in the page.csv layout"""
+    data = data.copy()
+    data["page"] = data["page"].map("{:03}".format)
+    for side in ("new", "old"):
+        data[side + "_bbox"] = [
+            "({}, {}, {}, {})".format(*box)
+            for box in zip(*(data[side + "_" + edge] for edge in BBOX_EDGES))
+        ]
+    # line endings and quoting as the csv module (and csvstack) write them
+    data[CSV_COLUMNS].to_csv(output, index=False, lineterminator="\r\n")
+
+
+@click.group()
+def book_store():
+    """The typed, columnar copy of each page's and the whole book's addresses"""
+    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+
+
+@book_store.command()
+@click.argument(
+    "page_dirs",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path),
+)
+def page(page_dirs):
+    """Write page.parquet (and page.csv) from each page's column-N-ocr.csv"""
+    for page_dir in page_dirs:
+        write_page(page_dir)
+
+
+@book_store.command()
+@click.argument(
+    "working", type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path)
+)
+@click.option(
+    "--book",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    help="Where to write the book (default: WORKING/book).",
+)
+@click.option("--csv", "csv_file", type=click.Path(), help="Also export it as csv.")
+@click.option(
+    "--rebuild", is_flag=True, help="Write every page again, not just the changed ones."
+)
+def book(working, book, csv_file, rebuild):
+    """Bring the book of every page under WORKING up to date"""
+    book = book or working / "book"
+    page_dirs = sorted(x for x in working.iterdir() if x.is_dir() and x != book)
+    update_book(book, page_dirs, rebuild)
+    if csv_file:
+        export_csv(load_book(book), csv_file)
+
+
+if __name__ == "__main__":
+    logger.remove()
+
+    book_store()
@@ -5,10 +5,12 @@ import re
 import sys
 
 import click
-import pandas as pd
 from PIL import Image
 from loguru import logger
 
+from raw_ocr import prepare_ocr_data
+from word_table import read_raw_ocr
+
 # sys.path.append(pathlib.Path(__file__).parent)
 # import config
 
@@ -39,10 +41,12 @@ def make_training_data(filename: pathlib.Path, prefix):
 
     column_id = int(re.match(r"column-([0-9]+)", filename.name).group(1))
 
-    ocr_data = pd.read_csv(
-        pathlib.Path(filename.with_name("column-{}-raw_ocr.csv".format(column_id)))
-    )
     base_img = Image.open(filename)
+    raw_ocr_csv = filename.with_name("column-{}-raw_ocr.csv".format(column_id))
+    if raw_ocr_csv.exists():
+        ocr_data = read_raw_ocr(raw_ocr_csv)
+    else:
+        ocr_data = prepare_ocr_data(base_img).reset_index(drop=True)
 
     mean_conf = ocr_data["conf"].mean()
     sd_conf = ocr_data["conf"].std()
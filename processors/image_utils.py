@@ -1,108 +1,226 @@
 #!/usr/bin/python
 
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2 as cv
 import numpy as np
-from PIL import Image, ImageOps
+from PIL import Image
 from scipy.ndimage import interpolation as inter
 from scipy.ndimage import label, morphology
 from loguru import logger
+
+import telemetry
+
 DEBUG = False
 
+# a page's proxy is shrunk this much by default, 600 dpi down to 150. Deskew
+# narrows its angle down on proxies before trying the last few at full size
+PROXY_SCALE = 4
+
+# threads this process's deskew scoring and OpenCV may use, None for one
+# per core. Pool workers are each given their share, see set_threads
+_threads = None
+
 
 def debug(*args):
     if DEBUG:
         print(*args)
 
 
+class BinaryImage:
+    """A black and white page (or part of one), converted from PIL once
+
+    bits is a bool array, True where the image is black. Crops are views on
+    the same array, and the row/column projection profiles are cached, so
+    this can be handed from stage to stage instead of re-deriving arrays
+    from PIL images every time."""
+
+    def __init__(self, bits: np.ndarray):
+        self.bits = bits
+        self._histograms = {}
+        self._proxies = {}
+
+    @classmethod
+    def from_image(cls, img):
+        # "1" mode is white where True
+        return cls(~np.asarray(img.convert("1")))
+
+    @classmethod
+    def open(cls, filename):
+        return cls.from_image(Image.open(filename))
+
+    @property
+    def size(self):
+        "(width, height), like PIL"
+        ht, wd = self.bits.shape
+        return wd, ht
+
+    def histogram(self, axis=0):
+        """count of black pixels in each column (axis=0) or row (axis=1)"""
+        if axis not in self._histograms:
+            self._histograms[axis] = np.count_nonzero(self.bits, axis=axis)
+        return self._histograms[axis]
+
+    def proxy(self, scale=PROXY_SCALE) -> np.ndarray:
+        """The image shrunk by scale, each cell the count of black pixels in
+        its scale x scale block. Cached, and the coarser ones are made from
+        the finer ones rather than from the full image."""
+        if scale not in self._proxies:
+            finer = [x for x in self._proxies if scale % x == 0]
+            if finer:
+                base = max(finer)
+                self._proxies[scale] = block_counts(self._proxies[base], scale // base)
+            else:
+                self._proxies[scale] = block_counts(self.bits, scale)
+        return self._proxies[scale]
+
+    def crop(self, box):
+        """A view of the (left, top, right, bottom) box, clipped to the image"""
+        wd, ht = self.size
+        left, top, right, bot = (int(round(x)) for x in box)
+        left, right = max(0, left), min(wd, right)
+        top, bot = max(0, top), min(ht, bot)
+        return BinaryImage(self.bits[top:bot, left:right])
+
+    def rotate(self, angle, backend="scipy"):
+        """Rotate by angle degrees around the centre, keeping the size"""
+        if not angle:
+            return self
+        return BinaryImage(ROTATE_BACKENDS[backend](self.bits, angle))
+
+    def grey(self):
+        "as an 8 bit greyscale array, black is 0"
+        return np.where(self.bits, 0, 255).astype(np.uint8)
+
+    def to_image(self):
+        return Image.fromarray(self.grey(), "L")
+
+    def save(self, fp, format=None):
+        self.to_image().save(fp, format)
+
+
+def as_binary(img) -> BinaryImage:
+    """Accept either a PIL image or a BinaryImage"""
+    if isinstance(img, BinaryImage):
+        return img
+    return BinaryImage.from_image(img)
+
+
 def get_histogram(img, axis=0):
-    wd, ht = img.size
-    pix = np.array(img.convert("1").getdata(), np.uint8)
-    bin_img = 1 - (pix.reshape((ht, wd)) / 255.0)
+    return as_binary(img).histogram(axis)
+
 
-    return np.sum(bin_img, axis)
+def along(axis, start, stop, ndim=2):
+    """index for cells start:stop along axis"""
+    index = [slice(None)] * ndim
+    index[axis] = slice(start, stop)
+    return tuple(index)
 
 
-def rrr(b):
-    v = np.array(b)
-    n = v == 0
-    # a = ~n
-    c = np.cumsum(v)
-    d = np.diff(np.concatenate(([0.0], c[n])))
-    v[n] = -d
-    q = np.cumsum(v)
+def trailing_run(x, axis=0):
+    """Length of the run of non-zero cells at the end of x along axis"""
+    zeros = np.flip(x == 0, axis)
+    return np.where(zeros.any(axis), zeros.argmax(axis), x.shape[axis])
 
-    return q
 
+def run_length(x, axis=0, flipped=True, start=0, stop=None):
+    """For each cell, the length of the run of non-zero cells along axis that
+    ends there (or, if flipped, starts there).
 
-def run_length(x, axis=0, flipped=True):
+    Only the cells start:stop along axis are returned, but runs reaching in
+    from outside that window are counted (that needs x to be 0/1).
+
+    The run is the cumulative sum since the last zero, i.e. the cumulative
+    sum minus its value at the most recent zero."""
+    length = x.shape[axis]
+    stop = length if stop is None else stop
     if flipped:
-        intermed = np.apply_along_axis(rrr, axis, np.flip(x, axis))
-        return np.flip(intermed, axis)
-    else:
-        return np.apply_along_axis(rrr, axis, x)
+        runs = run_length(np.flip(x, axis), axis, False, length - stop, length - start)
+        return np.flip(runs, axis)
 
+    window = x[along(axis, start, stop, x.ndim)]
+    # run lengths are bounded by the image size, so int32 is plenty
+    c = np.cumsum(window, axis=axis, dtype=np.int32)
+    runs = c - np.maximum.accumulate(np.where(window == 0, c, 0), axis=axis)
+    if start:
+        # add the runs that started before the window
+        carry = trailing_run(x[along(axis, 0, start, x.ndim)], axis)
+        open_run = ~np.logical_or.accumulate(window == 0, axis=axis)
+        runs += np.expand_dims(carry, axis).astype(np.int32) * open_run
+    return runs
 
-def find_max_square(a, margin=0.1):
-    pts = []
-    min_sq = a.shape[0] * a.shape[1] * 0.80
-    for flip in (True, False):
 
-        col_wise, row_wise = run_length(a, 1, flip), run_length(a, 0, flip)
+def argmax_2d(a, offset=(0, 0)):
+    """Position of the (first) maximum of a, shifted by offset.
+
+    (0, 0) if a is all zeroes, like argmax of a zeroed-out full matrix."""
+    if not a.size or not a.max():
+        return 0, 0
+    r, c = np.unravel_index(a.argmax(), a.shape)
+    return r + offset[0], c + offset[1]
 
-        sc = col_wise * row_wise
 
-        # fill everything inside the margins with zeroes, so we don't
-        # pick a best crop that's too narrow
-        ht, wd = sc.shape
-        # print(sc)
-        # print(flip)
+def find_max_square(a, margin=0.1):
+    """Top left and bottom right corners of the biggest white area of a
+
+    a is 0/1, white is 1. For each corner, only the cells within `margin` of
+    that corner can be picked, so we only work out run lengths for those
+    cells (and, for the fall back, the strips along the edges)."""
+    pts = []
+    ht, wd = a.shape
+    min_sq = ht * wd * 0.80
+    h_m, w_m = int(ht * margin), int(wd * margin)
+    for flip in (True, False):
         if flip:
-            sc[int(ht * margin) :] = 0
-            sc[:, int(wd * margin) :] = 0
-            # ,int(wd*margin):] = 0
+            # runs starting in the top left corner
+            top, left = 0, 0
         else:
-            sc[: ht - int(ht * margin)] = 0
-            sc[:, : wd - int(wd * margin)] = 0
+            # runs ending in the bottom right corner
+            top, left = ht - h_m, wd - w_m
 
-        # print(sc)
-        argm = sc.argmax()
+        col_wise = run_length(a[top : top + h_m], 1, flip, left, left + w_m)
+        row_wise = run_length(a[:, left : left + w_m], 0, flip, top, top + h_m)
+        sc = col_wise.astype(np.int64) * row_wise
+
+        r, c = argmax_2d(sc, (top, left))
+        # n.b. this compares the flat index, not the size of the crop
+        argm = r * wd + c
         if argm <= min_sq:
             # the crop we found is too small, fall back on the longest runs
-            # print("ERROR:", argm, min_sq)
-            # only zero-out parts of the matrix, as we need the longest run
+            # along the edges
             if flip:
-                col_wise[int(ht * margin) :] = 0
-                # col_wise[:,int(wd*margin):] =0
-                # row_wise[int(ht*margin):] = 0
-                row_wise[:, int(wd * margin) :] = 0
+                col_wise = run_length(a[:h_m], 1, flip)
+                row_wise = run_length(a[:, :w_m], 0, flip)
+                max_col = argmax_2d(col_wise)
+                max_row = argmax_2d(row_wise)
             else:
-                # col_wise[:ht-int(ht*margin)] = 0
-                col_wise[:, : wd - int(wd * margin)] = 0
-                row_wise[: ht - int(ht * margin)] = 0
-                # row_wise[:,:wd-int(wd*margin)] = 0
-            max_col = np.unravel_index(col_wise.argmax(), col_wise.shape)
-            max_row = np.unravel_index(row_wise.argmax(), row_wise.shape)
+                col_wise = run_length(a, 1, flip, wd - w_m, wd)
+                row_wise = run_length(a, 0, flip, ht - h_m, ht)
+                max_col = argmax_2d(col_wise, (0, wd - w_m))
+                max_row = argmax_2d(row_wise, (ht - h_m, 0))
             pt = (max_col[0], max_row[1])
         else:
-            pt = np.unravel_index(argm, sc.shape)
+            pt = (r, c)
         pts.append((pt[1], pt[0]))
 
     return pts[0], pts[1]
 
 
 def max_square_crop(img):
-    wd, ht = img.size
-
-    im = np.array(img.convert("1").getdata(), np.uint8).reshape((ht, wd)) / 255.0
+    """Crop to the biggest white area of the page"""
+    # white is 1
+    im = (~as_binary(img).bits).view(np.uint8)
 
     # im = morphology.grey_closing(im, (1, 101))
     # t, im = cv.threshold(im, 0, 1, cv.THRESH_OTSU)
 
-    # "Clean noise".
-    im = morphology.grey_opening(im, (51, 51))
+    # "Clean noise". cv2's flat opening ignores what's past the edge, which
+    # comes to the same as scipy's reflected edges, many times quicker
+    im = cv.morphologyEx(im, cv.MORPH_OPEN, np.ones((51, 51), np.uint8))
 
     a, b = find_max_square(im)
-    # print(a+b)
     return img.crop(a + b)
 
 
@@ -242,7 +360,7 @@ def newish_crop(img):
 
 def auto_crop(img):
     # print(img.size)
-    im = np.array(img, dtype=np.uint8)
+    im = as_binary(img).grey()
 
     im = morphology.grey_closing(im, (1, 101))
     t, im = cv.threshold(im, 0, 1, cv.THRESH_OTSU)
@@ -295,10 +413,9 @@ def silly_crop(img):
     """Attempt to remove the rows/columns from the edges that are 98-100% black or white"""
     wd, ht = img.size
 
-    pix = np.array(img.convert("1").getdata(), np.uint8)
-    bin_img = 1 - (pix.reshape((ht, wd)) / 255.0)
+    page = as_binary(img)
 
-    hist = np.sum(bin_img, axis=0)
+    hist = page.histogram(axis=0)
     t = 0.03
     min_t_y = ht * t
     max_t_y = ht * (1 - t)
@@ -312,7 +429,7 @@ def silly_crop(img):
     while hist[x_max] <= min_t_y or hist[x_max] >= max_t_y:
         x_max -= 1
 
-    hist = np.sum(bin_img, axis=1)
+    hist = page.histogram(axis=1)
 
     y_min = 0
     y_max = ht - 1
@@ -335,8 +452,43 @@ def find_deskew_score(arr, angle, axis, simple=False):
         return hist, score
 
 
-def find_deskew_score(arr, angle, axis, simple=False):
-    data = inter.rotate(arr, angle, reshape=False, order=0)
+def scipy_rotate(arr, angle):
+    """Rotate a 2d array by angle degrees around its centre, keeping the size"""
+    return inter.rotate(arr, angle, reshape=False, order=0)
+
+
+def cv_rotate(arr, angle):
+    """Like scipy_rotate, but with OpenCV, which lets go of the GIL and
+    works on 8 bit pixels (and spreads the work over more than one core)
+    where scipy converts to float64. The nearest neighbours are rounded a
+    little differently, so it can tie-break an angle the other way."""
+    ht, wd = arr.shape
+    # same direction and centre as scipy.ndimage.rotate
+    matrix = cv.getRotationMatrix2D(((wd - 1) / 2, (ht - 1) / 2), angle, 1)
+    if arr.dtype == bool:
+        src = arr.view(np.uint8)
+    elif arr.dtype in (np.uint8, np.uint16, np.float32, np.float64):
+        src = arr
+    else:
+        src = arr.astype(np.float32)
+    data = cv.warpAffine(src, matrix, (wd, ht), flags=cv.INTER_NEAREST, borderValue=0)
+    return data.view(bool) if arr.dtype == bool else data
+
+
+ROTATE_BACKENDS = {"scipy": scipy_rotate, "cv2": cv_rotate}
+
+
+def set_threads(threads):
+    """Keep this process to threads threads, for deskew's scoring and for
+    OpenCV's own. Used as a pool initializer, so that several workers on
+    one machine don't each start a thread per core."""
+    global _threads
+    _threads = threads
+    cv.setNumThreads(threads)
+
+
+def find_deskew_score(arr, angle, axis, simple=False, backend="scipy"):
+    data = ROTATE_BACKENDS[backend](arr, angle)
     hist = np.sum(data, axis=axis)
     if simple:
         # attempt to maximize highest peak
@@ -352,41 +504,251 @@ def find_deskew_score(arr, angle, axis, simple=False):
     return hist, score
 
 
-def deskew(img, delta=0.1, limit=1, axis=0, simple=False):
-    # convert to binary
-    wd, ht = img.size
+def rotation_scorer(arr, axis=0, simple=False, backend="scipy"):
+    """Score skew angles by resampling the whole of arr at each one"""
 
-    pix = np.array(img.convert("1").getdata(), np.uint8)
-    bin_img = 1 - (pix.reshape((ht, wd)) / 255.0)
+    def score(angle):
+        telemetry.count("angles")
+        hist, score = find_deskew_score(arr, angle, axis, simple, backend)
+        return score
 
-    # hist = np.sum(bin_img, axis=0) # along y axis
+    return score
 
-    delta = 0.025
-    limit = 0.5
-    angles = np.arange(-limit, limit + delta, delta)
+
+def projection_scorer(arr, axis=0, simple=False, backend=None):
+    """Score skew angles like find_deskew_score, but without resampling
+
+    The coordinates of the black pixels are taken once, and for each angle
+    they're rotated and binned into the same histogram the rotated image
+    would give, so each angle costs O(black pixels). Nothing is rotated,
+    so there's no backend to choose."""
+
+    ys, xs = np.nonzero(arr)
+    # a shrunk copy has partly-black pixels
+    weights = None if arr.dtype == bool else arr[ys, xs]
+    ht, wd = arr.shape
+    cy, cx = (ht - 1) / 2, (wd - 1) / 2
+    y, x = ys - cy, xs - cx
+
+    def score(angle):
+        telemetry.count("angles")
+        # same direction and centre as scipy.ndimage.rotate
+        theta = np.deg2rad(angle)
+        new_y = np.rint(cy + y * np.cos(theta) - x * np.sin(theta)).astype(np.intp)
+        new_x = np.rint(cx + x * np.cos(theta) + y * np.sin(theta)).astype(np.intp)
+        # whatever rotates out of the frame is lost, as it would be in the image
+        keep = (new_y >= 0) & (new_y < ht) & (new_x >= 0) & (new_x < wd)
+        kept = None if weights is None else weights[keep]
+        if axis == 0:
+            hist = np.bincount(new_x[keep], kept, minlength=wd)
+        else:
+            hist = np.bincount(new_y[keep], kept, minlength=ht)
+        if simple:
+            return max(hist)
+        return np.var(hist, axis=0)
+
+    return score
+
+
+SKEW_SCORERS = {"rotate": rotation_scorer, "projection": projection_scorer}
+
+# "lines" measures the page's bars and rules instead of searching, see
+# line_skew, falling back on the projection search where it can't
+DESKEW_METHODS = sorted(SKEW_SCORERS) + ["lines"]
+
+
+def block_counts(arr, factor):
+    """Shrink a 2d array by summing each factor x factor block, dropping
+    the odd rows and columns at the end"""
+    ht, wd = arr.shape
+    ht, wd = ht - ht % factor, wd - wd % factor
+    # each block holds at most (factor * factor) times the biggest cell
+    if arr.dtype == bool:
+        arr = arr.view(np.uint8)
+        biggest = factor * factor
+    else:
+        biggest = int(arr.max(initial=0)) * factor * factor
+    dtype = np.uint16 if biggest < (1 << 16) else np.uint32
+    # summing the rows of each block and then its columns, rather than
+    # both at once, is several times quicker
+    rows = arr[:ht, :wd].reshape(ht // factor, factor, wd).sum(axis=1, dtype=dtype)
+    return rows.reshape(ht // factor, wd // factor, factor).sum(axis=2, dtype=dtype)
+
+
+def golden_section_max(f, lo, hi, tol):
+    """Find the x in [lo, hi] maximizing the unimodal f, to within tol"""
+    ratio = (np.sqrt(5) - 1) / 2
+    a, b = lo + (1 - ratio) * (hi - lo), lo + ratio * (hi - lo)
+    fa, fb = f(a), f(b)
+    while hi - lo > tol:
+        if fa >= fb:
+            hi, b, fb = b, a, fa
+            a = lo + (1 - ratio) * (hi - lo)
+            fa = f(a)
+        else:
+            lo, a, fa = a, b, fb
+            b = lo + ratio * (hi - lo)
+            fb = f(b)
+    return (lo + hi) / 2
+
+
+def find_skew_angle(
+    bin_img,
+    delta=0.025,
+    limit=0.5,
+    axis=0,
+    simple=False,
+    scale=8,
+    method="rotate",
+    backend="scipy",
+    threads=None,
+):
+    """Estimate the skew angle of a binary image, to the nearest delta within +/- limit
+
+    Scan the whole range in coarse steps on a copy shrunk by `scale`, narrow
+    it down with a golden-section search on a copy shrunk half as much, and
+    only score the last few neighbouring delta steps at full resolution.
+
+    bin_img is a bool array or a BinaryImage, whose cached proxies are used
+    for the shrunk copies. They hold block counts rather than averages,
+    which scales every score by the same power of two and so picks the
+    same angles.
+
+    method picks how candidate angles are scored, see SKEW_SCORERS, and
+    backend what rotates the image for the "rotate" scorer.
+
+    The coarse angles, and the full resolution climb in each direction,
+    are scored on threads. That only pays when the scoring lets go of the
+    GIL, so by default the cv2 backend gets a thread per core (or the
+    process's share of them, see set_threads) and the others none."""
+
+    args = bin_img, delta, limit, axis, simple, scale, method, backend
+    if threads is None:
+        threads = (_threads or os.cpu_count()) if backend == "cv2" else 1
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            return _find_skew_angle(*args, pool.map)
+    return _find_skew_angle(*args, map)
+
+
+def _find_skew_angle(
+    bin_img, delta, limit, axis, simple, scale, method, backend, mapper
+):
+    scorer = functools.partial(SKEW_SCORERS[method], backend=backend)
+    if isinstance(bin_img, BinaryImage):
+        shrink = bin_img.proxy
+        bin_img = bin_img.bits
+    else:
+        shrink = functools.partial(block_counts, bin_img)
+
+    while scale > 1 and min(bin_img.shape) // scale < 64:
+        # don't shrink small images into nothing
+        scale //= 2
+    small = shrink(scale) if scale > 1 else bin_img
+    step = min(delta * scale, limit)
+
+    score = scorer(small, axis, simple)
+    angles = np.arange(-limit, limit + step / 2, step)
+    coarse = dict(zip(angles, mapper(score, angles)))
+    debug("coarse scores", coarse)
+    angle = max(coarse, key=coarse.get)
+
+    if scale > 2:
+        # refine between the neighbouring coarse steps on a less shrunk copy
+        score = scorer(shrink(scale // 2), axis, simple)
+        lo, hi = max(-limit, angle - step), min(limit, angle + step)
+        angle = golden_section_max(score, lo, hi, delta / 2)
+
+    # at full resolution, climb along the delta grid from the estimate
+    score = scorer(bin_img, axis, simple)
     scores = {}
-    last_score = 0
-    for angle in np.arange(0, limit + delta, delta):
-        hist, score = find_deskew_score(bin_img, angle, axis, simple)
-        debug("angle", angle, "score", score)
-        if score < last_score:
-            break
-        last_score = score
-        scores[score] = (angle, hist)
-    last_score = 0
-    for angle in np.arange(0, -limit, -delta):
-        hist, score = find_deskew_score(bin_img, angle, axis, simple)
-        debug("angle", angle, "score", score)
-        if score < last_score:
-            break
-        last_score = score
-        scores[score] = (angle, hist)
-
-    best_score = max(scores)
-    best_angle, best_hist = scores[best_score]
-    logger.info("Best angle: {}",best_angle)
+
+    def grid_score(i):
+        if i not in scores:
+            scores[i] = score(i * delta)
+            debug("angle", i * delta, "score", scores[i])
+        return scores[i]
+
+    i = int(np.round(angle / delta))
+    n = int(limit / delta + 1e-9)
+    i = min(max(i, -n), n)
+    grid_score(i)
+
+    def climb(direction):
+        """Step away from i while the score keeps going up"""
+        j = i
+        while -n <= j + direction <= n and grid_score(j + direction) > grid_score(j):
+            j += direction
+        return j
+
+    # both directions at once, each stopping as soon as it's past its peak
+    down, up = mapper(climb, (-1, 1))
+    # stay put on ties
+    return max((i, down, up), key=grid_score) * delta
+
+
+def deskew_angle(
+    img,
+    delta=0.025,
+    limit=0.5,
+    axis=0,
+    simple=False,
+    method="rotate",
+    backend="scipy",
+) -> float:
+    """The angle deskew would rotate img by, without rotating it"""
+
+    page = as_binary(img)
+
+    width, height = page.size
+    with telemetry.stage(
+        "deskew",
+        axis=axis,
+        method=method,
+        backend=backend,
+        width=width,
+        height=height,
+    ):
+        if method == "lines":
+            # imported here, line_skew needs the stages that import us
+            from line_skew import line_angle
+
+            try:
+                best_angle = line_angle(page, axis, limit)
+            except RuntimeError as e:
+                logger.warning("{}, searching instead", e)
+                telemetry.note(fallback=True)
+                method = "projection"
+        if method != "lines":
+            best_angle = find_skew_angle(
+                page, delta, limit, axis, simple, method=method, backend=backend
+            )
+        logger.info("Best angle: {}", best_angle)
+        telemetry.note(angle=best_angle)
+        return best_angle
+
+
+def deskew(
+    img,
+    delta=0.025,
+    limit=0.5,
+    axis=0,
+    simple=False,
+    method="rotate",
+    backend="scipy",
+):
+    """Rotate img so its rows (axis=0) or columns (axis=1) line up
+
+    The angle is found to within delta degrees, searching +/- limit degrees,
+    scoring candidates with the given method ("rotate" or "projection"), or
+    fitted to the page's ruled lines ("lines"). Either way the image itself
+    is only rotated once, by the best angle, with the given backend (see
+    ROTATE_BACKENDS).
+
+    Takes a PIL image or BinaryImage, returns a BinaryImage."""
+
+    page = as_binary(img)
 
     # correct skew
-    data = inter.rotate(bin_img, best_angle, reshape=False, order=0)
-    img = ImageOps.invert(Image.fromarray((255 * data).astype("uint8")).convert("L"))
-    return img
+    angle = deskew_angle(page, delta, limit, axis, simple, method, backend)
+    return page.rotate(angle, backend)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import numpy as np
+
+from auto_crop_page import find_top_two_lines
+from image_utils import BinaryImage
+from street_correct import find_five_columns
+
+# the most a line can be skewed and still be found, in degrees
+LIMIT = 0.5
+
+# rows (or columns) whose centre is further than this many pixels from the
+# first fit are taken to be something else touching the line, and dropped
+OUTLIER = 3
+
+
+def fit_line(bits: np.ndarray, lo, hi, axis=0):
+    """Fit the thick line (or lines, side by side) in the band lo:hi of
+    bits, running down the rows (axis=0) or along the columns (axis=1)
+
+    Each row of the band (column, for axis=1) gives the centre of its black
+    pixels, and a least squares line is fitted to those, once, and again
+    without the ones that were off it. Rows with much more or less black
+    in them than most are left out, they're crossed by something else.
+
+    Returns the slope, pixels across per pixel along."""
+
+    band = bits[:, lo:hi] if axis == 0 else bits[lo:hi].T
+    counts = np.count_nonzero(band, axis=1)
+    if not counts.any():
+        raise RuntimeError("no line between {} and {}".format(lo, hi))
+    usual = np.median(counts[counts > 0])
+    keep = (counts >= usual / 2) & (counts <= usual * 1.5)
+    along = np.nonzero(keep)[0]
+    if len(along) < len(counts) / 4:
+        raise RuntimeError("no line between {} and {}".format(lo, hi))
+    across = (band[along] @ np.arange(lo, hi)) / counts[along]
+
+    slope, intercept = np.polyfit(along, across, 1)
+    near = np.abs(across - (slope * along + intercept)) <= OUTLIER
+    if near.sum() >= len(along) / 2:
+        slope, intercept = np.polyfit(along[near], across[near], 1)
+    return slope
+
+
+def drift(length, limit=LIMIT):
+    """How far a line this long wanders either side of its middle"""
+    return int(np.ceil(np.tan(np.deg2rad(limit)) * length / 2))
+
+
+def bar_angles(page: BinaryImage, limit=LIMIT, limits=None) -> list:
+    """The angle to rotate by to stand each of the four bars up straight
+
+    limits are the column limits find_five_columns gives, if we have them"""
+    width, height = page.size
+    if limits is None:
+        limits = find_five_columns(page)
+    bars = [right for left, right in limits[:-1]]
+    # wide enough for the bar at its most skewed, but not the type beside it
+    half = drift(height, limit) + 16
+    angles = []
+    for x in bars:
+        slope = fit_line(page.bits, max(x - half, 0), min(x + half, width), axis=0)
+        angles.append(-np.rad2deg(np.arctan(slope)))
+    return angles
+
+
+def column_skew(page: BinaryImage, limit=LIMIT, limits=None):
+    """The page's skew from the four bars, and how much each of the five
+    columns is skewed beyond that, going by the bars either side of it
+
+    Angles are what to rotate by to straighten them, as with deskew."""
+    angles = bar_angles(page, limit, limits)
+    page_angle = float(np.median(angles))
+    residuals = []
+    for i in range(len(angles) + 1):
+        sides = angles[max(i - 1, 0) : i + 1]
+        residuals.append(float(np.mean(sides)) - page_angle)
+    return page_angle, residuals
+
+
+def rule_angle(page: BinaryImage, limit=LIMIT) -> float:
+    """The angle to rotate by to lay the two rules across the top flat"""
+    width, height = page.size
+    hist = page.histogram(axis=1)
+    try:
+        peak = find_top_two_lines(page)
+    except IndexError:
+        raise RuntimeError("no rules across the top")
+    # the rules, down to the white before the type starts. The bars hang
+    # from the lower rule, but are much too thin to count
+    ink = hist > hist[peak] / 10
+    top = peak
+    while top > 0 and ink[top - 1]:
+        top -= 1
+    bot = peak
+    while bot < height - 1 and ink[bot + 1]:
+        bot += 1
+    slope = fit_line(page.bits, top, bot + 1, axis=1)
+    return float(np.rad2deg(np.arctan(slope)))
+
+
+def line_angle(page: BinaryImage, axis=0, limit=LIMIT) -> float:
+    """The angle deskew's search would find, from the page's ruled lines:
+    the bars for axis=0, the top rules for axis=1
+
+    Raises RuntimeError if the lines can't be found, or are skewed more
+    than limit."""
+    if axis == 0:
+        angle = column_skew(page, limit)[0]
+    else:
+        angle = rule_angle(page, limit)
+    if abs(angle) > limit:
+        raise RuntimeError("lines skewed {:.2f} degrees".format(angle))
+    return angle
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
-import ast
 import pathlib
 
 import click
 import jinja2
 import pandas
 
+from book_store import load_book
+
 TEMPLATES_DIR = pathlib.Path(__file__).parent / "templates"
 
+# all the index needs of the book
+BOOK_COLUMNS = ["page", "street", "new_conf", "old_conf"]
+
 
 class Book:
     def __init__(self, data_table):
@@ -17,6 +21,11 @@ class Book:
 
             self.pages.append(Page(page_id, page_data_table))
 
+    @classmethod
+    def from_store(cls, book_dir: pathlib.Path, pages=None):
+        """The book as book_store.update_book last left it"""
+        return cls(load_book(book_dir, columns=BOOK_COLUMNS, pages=pages))
+
     def render(self):
 
         t = jinja2.Template(open(TEMPLATES_DIR / "book_index_template.html").read())
@@ -46,12 +55,12 @@ class Page:
 @click.command()
 @click.argument("infile", type=click.Path(exists=True, path_type=pathlib.Path))
 def reconstruct(infile: pathlib.Path):
-    """Using a CSV file, reconstruct what the column may have looked like"""
+    """Using the book store (or a CSV file), make an index of the book's pages"""
 
-    in_data = pandas.read_csv(
-        infile,
-    )
-    book = Book(in_data)
+    if infile.is_dir():
+        book = Book.from_store(infile)
+    else:
+        book = Book(pandas.read_csv(infile))
 
     print(book.render())
 
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import copy
 import csv
 import itertools
 import pathlib
@@ -9,12 +8,25 @@ import sys
 import typing
 
 import click
+import numpy as np
 import pandas as pd
 from loguru import logger
 from numpy import nan
 
 sys.path.append(str(pathlib.Path(__file__).parent.parent))
 import config
+import telemetry
+from word_table import WordTable, read_raw_ocr
+
+# stage cache version for the column parser
+STAGE_VERSION = 1
+
+# the columns of a page, left to right
+COLUMNS = range(1, 6)
+
+# the name a column's leading street is given when it's parsed on its own,
+# until stitch.py fills in whatever the column before it ended on
+CONTINUED_STREET = "(continued)"
 
 
 def probable_street_name(text: str):
@@ -33,57 +45,39 @@ def probable_street_name(text: str):
     return False
 
 
-class Text:
-    def __init__(self, item):
-        self.text = item["text"]
-        self.line_num = item["line_num"]
-        self.conf = item["conf"]
-        self.top = item["top"]
-        self.left = item["left"]
-        self.right = item["right"]
-        self.bot = item["bot"]
-        self.flag = False
-
-    @property
-    def bbox(self):
-        return (self.left, self.top, self.right, self.bot)
-
-    def __repr__(self):
-        return "<{!r} ({})>".format(self.text, self.conf)
-
-    def __add__(self, other):
-        d = {}
-        d["text"] = self.text + " " + other.text
-        d["conf"] = min(self.conf, other.conf)
-        d["top"] = max(self.top, other.top)
-        d["left"] = min(self.left, other.left)
-        d["right"] = max(self.right, other.right)
-        d["bot"] = min(self.bot, other.bot)
-        d["line_num"] = self.line_num
-        return Text(d)
-
-    def split(self):
-        "split this if it has a |"
-        texts = []
-        if "|" in self.text:
-            for subtext in self.text.split("|"):
-                if subtext:
-                    new_text = copy.copy(self)
-                    new_text.text = subtext
-                    texts.append(new_text)
-        else:
-            texts = [self]
-        return texts
+def parse_ocr_row(words: WordTable, positions):
+    """positions are the rows of one line, in their original order"""
 
-
-def parse_ocr_row(group):
-
-    row_height = group["height"].min()
-    texts = [Text(row).split() for i, row in group.iterrows()]
+    row_height = words.height(positions)
+    texts = [text.split() for text in words.texts(positions)]
     texts = list(itertools.chain.from_iterable(texts))
     return (row_height, texts)
 
 
+def renumber_lines(ocr_data):
+    """unfortunately, sometimes there's more than one "paragraph" in the way
+    the OCR segments the column, so we need to calcuate a unique line number:
+    each (block, paragraph) is offset by the line count of the ones before it"""
+    keys = ["block_num", "par_num"]
+    line_counts = ocr_data.groupby(keys)["line_num"].max()
+    offsets = (line_counts.cumsum() - line_counts).to_numpy()
+    ocr_data["line_num"] = (
+        ocr_data["line_num"] + offsets[ocr_data.groupby(keys).ngroup().to_numpy()]
+    )
+
+
+def line_groups(ocr_data):
+    """Yield the positions of each (block_num, par_num, line_num) line's rows,
+    lines in key order and rows in their original order"""
+    keys = ocr_data[["block_num", "par_num", "line_num"]].to_numpy()
+    order = np.lexsort(keys.T[::-1])  # stable, like groupby
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    ends = np.r_[starts[1:], len(order)]
+    for start, end in zip(starts, ends):
+        yield order[start:end]
+
+
 def within(x, pct, value):
     return value * (1 - pct) <= x <= value * (1 + pct)
 
@@ -239,29 +233,25 @@ class Street:
 
         column.loc[column["address"].mod(2) == col_one_oddeven, "address"] = nan
 
-        # score for monotonicity
-        null_out_mono_errors(column, "address")
-
-        for i in column[column["address"].isna()].index:
+        flags = address_flags(column)
+        for i in np.flatnonzero(flags):
             logger.debug(
                 "{} doesn't seem right in row {}...",
                 col_one[i][0].text,
                 col_one[i][0].line_num,
             )
             col_one[i][0].flag = True  # clear text of nas
-        error_count = column["address"].isnull().sum()
+        error_count = flags.sum()
 
         if col_two:
             column = make_column_dataframe(col_two)
             # column two is always even
             column.loc[column["address"].mod(2) == 1, "address"] = nan
 
-            # score for monotonicity
-            null_out_mono_errors(column, "address")
-
-            for i in column[column["address"].isna()].index:
+            flags = address_flags(column)
+            for i in np.flatnonzero(flags):
                 col_two[i][0].flag = True  # clear text of nas
-            error_count += column["address"].isnull().sum()
+            error_count += flags.sum()
 
         return error_count
 
@@ -312,36 +302,84 @@ def remove_weird_rows(ocr_data):
     return ocr_data
 
 
-def null_out_mono_errors(df, column_name):
-    "set df[column_name] to NaN when the value isn't monotonically increasing" ""
-    for i, row in df.iterrows():
+class RankCounts:
+    """A Fenwick tree counting how many values of each rank we hold"""
+
+    def __init__(self, size: int):
+        self.tree = [0] * (size + 1)
+        self.total = 0
+
+    def add(self, rank: int, count=1):
+        self.total += count
+        rank += 1
+        while rank < len(self.tree):
+            self.tree[rank] += count
+            rank += rank & -rank
 
-        score = mono_score(df[column_name], i)
-        if score > 1 and row[column_name]:
-            df.loc[i, column_name] = nan
+    def below(self, rank: int) -> int:
+        "how many values have a rank less than this one"
+        count = 0
+        while rank > 0:
+            count += self.tree[rank]
+            rank -= rank & -rank
+        return count
+
+
+def null_out_mono_errors(df, column_name):
+    """set df[column_name] to NaN when the value isn't monotonically increasing
+
+    A value's disagreement is the number of values before it that aren't
+    smaller, plus the values after it that are. Going down the column, a value
+    whose squared disagreement is more than the column's length is nulled,
+    and so doesn't count against the values after it. Keeping the surviving
+    values before, and all the values after, in rank order makes each
+    row's count O(log n).
+
+    Returns the disagreement score of each row."""
+
+    values = df[column_name].to_numpy(dtype=float)
+    present = ~np.isnan(values)
+    distinct = np.unique(values[present])
+    ranks = np.searchsorted(distinct, values)
+
+    before = RankCounts(len(distinct))
+    after = RankCounts(len(distinct))
+    for rank in ranks[present]:
+        after.add(rank)
+
+    scores = np.zeros(len(values))
+    errors = np.zeros(len(values), dtype=bool)
+    for i, (value, rank) in enumerate(zip(values, ranks)):
+        if not present[i]:
+            # nothing compares greater than NaN
+            scores[i] = before.total**2 / len(values)
+            continue
+        after.add(rank, -1)
+        disagree = before.total - before.below(rank) + after.below(rank)
+        scores[i] = disagree**2 / len(values)
+        if scores[i] > 1 and value:
+            errors[i] = True
+        else:
+            before.add(rank)
 
+    if errors.any():
+        df.loc[errors, column_name] = nan
+    return scores
 
-def mono_score(series, i):
-    # diff should be positive below and positive above
-    #                 v
-    # 100  102  104  106   108   110   112
-    # true true true false false false false # x[i] - x[n] > 0
-    # true true true false false false false # n < i
-    diff = (series[i] - series) > 0
-    index = series.index < i
-    comparison = diff != index
 
-    return comparison.where(series.notna()).sum() ** 2 / len(series)
+def address_flags(column) -> np.ndarray:
+    """Which of a column's addresses to flag, from their disagreement
+    scores (see null_out_mono_errors): the ones with no number to place,
+    or the wrong parity, and the ones too far out of order. A 0 is never
+    out of order."""
+    addresses = column["address"].to_numpy(dtype=float)
+    scores = null_out_mono_errors(column, "address")
+    return np.isnan(addresses) | ((scores > 1) & (addresses != 0))
 
 
-def set_error(df, group_id, error_msg):
-    # add an error message to the group
-    df.loc[
-        (df["block_num"] == group_id[0])
-        & (df["par_num"] == group_id[1])
-        & (df["line_num"] == group_id[2]),
-        "error",
-    ] = error_msg
+def set_error(errors, positions, error_msg):
+    # add an error message to the group's rows
+    errors[positions] = error_msg
 
 
 def get_previous_street_name(column_id: int, output_path) -> str:
@@ -376,10 +414,15 @@ def get_previous_street_name(column_id: int, output_path) -> str:
     type=click.Path(),
     help="Write out some errors to this file in csv format.",
 )
+@click.option(
+    "--continued",
+    is_flag=True,
+    help="Don't look at the previous column, start with a placeholder street for stitch.py.",
+)
 @click.option("--normal", "log_level", flag_value="SUCCESS", default=True)
 @click.option("--verbose", "log_level", help="Verbose mode.", flag_value="INFO")
 @click.option("--debug", "log_level", help="Debug mode.", flag_value="DEBUG")
-def ocr_column(filename: pathlib.Path, output, errors, log_level):
+def ocr_column(filename: pathlib.Path, output, errors, continued, log_level):
     """
     Read in the raw ocr from csv, transform it into street-based address transformation and apply basic error catching.
     """
@@ -388,78 +431,113 @@ def ocr_column(filename: pathlib.Path, output, errors, log_level):
 
     logger.add(sys.stderr, format="<level>{message}</level>", level=log_level)
 
+    try:
+        if continued:
+            prev_street_name = CONTINUED_STREET
+        else:
+            prev_street_name = get_previous_street_name(column_number(filename), output)
+        parse_column(filename, output, errors, prev_street_name)
+    except RuntimeError as e:
+        logger.error("{}", e)
+        sys.exit(1)
+
+
+def column_number(filename: pathlib.Path) -> int:
+    return int(re.match(r"column-([0-9]+)", filename.name).group(1))
+
+
+def parsed_path(filename: pathlib.Path) -> pathlib.Path:
+    """column-N-raw_ocr.csv -> column-N-parsed.csv"""
+    return filename.with_name("column-{}-parsed.csv".format(column_number(filename)))
+
+
+def parse_page(page_dir: pathlib.Path, columns=COLUMNS):
+    """Parse each of a page's raw ocr csvs into its column-N-parsed.csv
+
+    The columns don't wait on each other: each one starts out
+    continuing CONTINUED_STREET, which stitch.py resolves afterwards."""
+
+    for i in columns:
+        raw_ocr_csv = page_dir / "column-{}-raw_ocr.csv".format(i)
+        parse_column(
+            raw_ocr_csv,
+            parsed_path(raw_ocr_csv),
+            errors=page_dir / "column-{}-e.csv".format(i),
+            prev_street_name=CONTINUED_STREET,
+        )
+
+
+def parse_column(
+    filename: pathlib.Path, output: pathlib.Path, errors=None, prev_street_name=None
+):
+    """Parse one column's raw ocr csv into an address csv, continuing
+    prev_street_name if the column starts partway through a street
+
+    Returns the column's streets"""
+
     # figure out our context
     page_id = filename.parent.name
-    column_id = int(re.match(r"column-([0-9]+)", filename.name).group(1))
+    column_id = column_number(filename)
     logger.info("Considering column {} on page {}", column_id, page_id)
-    prev_street_name = get_previous_street_name(column_id, output)
-
-    # read in the raw ocr data
-    ocr_data = pd.read_csv(filename)
-
-    ocr_data = remove_weird_rows(ocr_data)
-
-    force = filename.with_name("force-ocr").exists()
-    street_info = handle_data(ocr_data, page_id, prev_street_name, errors, force)
-
-    with open(output, "w") as output_fp:
-        output_csv = csv.DictWriter(
-            output_fp,
-            [
-                "page",
-                "column",
-                "line_num",
-                "street",
-                "new",
-                "old",
-                "new_conf",
-                "old_conf",
-                "new_bbox",
-                "old_bbox",
-                "flag",
-            ],
-            quoting=csv.QUOTE_NONNUMERIC,
-        )
-        output_csv.writeheader()
-        for street in street_info:
-            if street.pairs:
-                errors = street.check_assumptions()
-                logger.success(
-                    "{}: {} pairs, {} numeric order errors".format(
-                        street.name, len(street.pairs), errors
+
+    with telemetry.stage("parse_column", page=page_id, column=column_id):
+        # read in the raw ocr data
+        ocr_data = read_raw_ocr(filename)
+
+        ocr_data = remove_weird_rows(ocr_data)
+
+        force = filename.with_name("force-ocr").exists()
+        street_info = handle_data(ocr_data, page_id, prev_street_name, errors, force)
+
+        with open(output, "w") as output_fp:
+            output_csv = csv.DictWriter(
+                output_fp,
+                [
+                    "page",
+                    "column",
+                    "line_num",
+                    "street",
+                    "new",
+                    "old",
+                    "new_conf",
+                    "old_conf",
+                    "new_bbox",
+                    "old_bbox",
+                    "flag",
+                ],
+                quoting=csv.QUOTE_NONNUMERIC,
+            )
+            output_csv.writeheader()
+            for street in street_info:
+                if street.pairs:
+                    errors = street.check_assumptions()
+                    logger.success(
+                        "{}: {} pairs, {} numeric order errors".format(
+                            street.name, len(street.pairs), errors
+                        )
                     )
-                )
-                street.output(column=column_id, outfile=output_csv)
+                    street.output(column=column_id, outfile=output_csv)
+        return street_info
 
 
 def handle_data(
     ocr_data: pd.DataFrame, page_id: int, prev_street_name: str, error_file, force: bool
+):
+    with telemetry.stage("handle_data", page=str(page_id), words=len(ocr_data)):
+        streets = _handle_data(ocr_data, page_id, prev_street_name, error_file, force)
+        telemetry.note(streets=len(streets), pairs=sum(len(x.pairs) for x in streets))
+        return streets
+
+
+def _handle_data(
+    ocr_data: pd.DataFrame, page_id: int, prev_street_name: str, error_file, force: bool
 ):
     height_mode = ocr_data["height"].mode()[0]  # mode is a series, just use the top
-    ocr_data["error"] = ""
-
-    # unfortunately, sometimes there's more than one "paragraph" in the way
-    # the OCR segments the column, so we need to calcuate a unique line number
-    prev_max = 0
-    adjusts = {}
-    for group_id, group in ocr_data.groupby(["block_num", "par_num"]):
-        new_max = group["line_num"].max()
-        adjusts[group_id] = prev_max
-        prev_max += new_max
-    for key, adj in adjusts.items():
-        block_num, par_num = key
-        ocr_data.loc[
-            (ocr_data["block_num"] == block_num) & (ocr_data["par_num"] == par_num),
-            "line_num",
-        ] = (
-            ocr_data[
-                (ocr_data["block_num"] == block_num) & (ocr_data["par_num"] == par_num)
-            ]["line_num"]
-            + adj
-        )
 
-    # group it into horizontally-aligned groups
-    grouped = ocr_data.groupby(["block_num", "par_num", "line_num"])
+    renumber_lines(ocr_data)
+
+    words = WordTable.from_frame(ocr_data)
+    errors = np.full(len(ocr_data), "", dtype=object)
 
     current_street = Street(prev_street_name, page_id=page_id)
 
@@ -473,10 +551,11 @@ def handle_data(
     error_count = 0
     success_count = 0
 
-    for group_id, group in grouped:
+    # horizontally-aligned groups
+    for positions in line_groups(ocr_data):
 
         result = False
-        row_height, texts = parse_ocr_row(group)
+        row_height, texts = parse_ocr_row(words, positions)
         combined_text = " ".join(x.text for x in texts)
 
         if row_height > 1.3 * height_mode or probable_street_name(combined_text):
@@ -488,17 +567,20 @@ def handle_data(
         elif within(row_height, 0.2, height_mode):
             result = current_street.parse_row(texts)
             if not result:
-                set_error(ocr_data, group_id, "{} unparsable".format(error_count))
+                set_error(errors, positions, "{} unparsable".format(error_count))
                 error_count += 1
             else:
                 success_count += 1
         else:
             result = False
-            set_error(ocr_data, group_id, "{} bad row height".format(error_count))
+            set_error(errors, positions, "{} bad row height".format(error_count))
             error_count += 1
 
         if not result:
-            failed_groups.append(group_id)
+            failed_groups.append(positions)
+
+    ocr_data["error"] = errors
+    telemetry.note(groups=error_count + success_count, rejected=error_count)
 
     if error_count:
         logger.warning(
@@ -507,15 +589,14 @@ def handle_data(
             )
         )
         if error_file:
-            groups = [grouped.get_group(i) for i in failed_groups]
-            failures = pd.concat(groups, axis=0, join="outer")
+            failures = ocr_data.iloc[np.concatenate(failed_groups)]
             failures.to_csv(error_file, quoting=csv.QUOTE_NONNUMERIC)
         if not force and error_count / (error_count + success_count) > 0.15:
-            logger.error(
-                "{}: Too many OCR errors, aborting. Fix the image, or reevaluate your life",
-                page_id,
+            raise RuntimeError(
+                "{}: Too many OCR errors, aborting. Fix the image, or reevaluate your life".format(
+                    page_id
+                )
             )
-            sys.exit(1)
     return streets
 
 
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+import csv
+import functools
+import io
+import multiprocessing
+import pathlib
+import sys
+import tempfile
+
+import pandas as pd
+import pytesseract
+from PIL import Image
+
+try:
+    # the tesseract C API, so the model can stay loaded between images
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import config
+
+# the columns of tesseract's tsv output, which is what image_to_data returns
+TSV_COLUMNS = [
+    "level",
+    "page_num",
+    "block_num",
+    "par_num",
+    "line_num",
+    "word_num",
+    "left",
+    "top",
+    "width",
+    "height",
+    "conf",
+    "text",
+]
+
+
+def read_tsv(tsv: str) -> pd.DataFrame:
+    """Parse tesseract tsv output the same way pytesseract does"""
+    return pd.read_csv(
+        io.StringIO(tsv), sep="\t", quoting=csv.QUOTE_NONE, names=TSV_COLUMNS
+    )
+
+
+def split_tsv(tsv: str):
+    """Split the tsv of a multi-image run into one tsv per image, each
+    numbered as page 1, as if every image had been run on its own"""
+    pages = []
+    for line in tsv.splitlines()[1:]:  # skip the header
+        fields = line.split("\t")
+        if len(fields) < len(TSV_COLUMNS):
+            continue
+        page = int(fields[1])
+        while len(pages) < page:
+            pages.append([])
+        fields[1] = "1"
+        pages[page - 1].append("\t".join(fields))
+    return ["\n".join(lines) + "\n" for lines in pages]
+
+
+class TesseractEngine:
+    """A loaded copy of the OCR model.
+
+    With tesserocr installed the model is loaded once, when the engine is
+    made, and every image after that only pays for recognition. Without it we
+    fall back on pytesseract, which runs the tesseract binary per image."""
+
+    def __init__(self, tessdata=None, model=None, psm=None):
+        self.tessdata = str(tessdata or config.OCR.TESSDATADIR)
+        self.model = model or config.OCR.MODEL
+        self.psm = str(psm or config.OCR.PSM)
+        self.api = None
+        if tesserocr is not None:
+            self.api = tesserocr.PyTessBaseAPI(
+                path=self.tessdata, lang=self.model, psm=int(self.psm)
+            )
+
+    def image_to_data(self, image) -> pd.DataFrame:
+        """OCR an image (PIL image or filename) into a word table, like
+        pytesseract.image_to_data(..., output_type=Output.DATAFRAME)"""
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+
+        if self.api is None:
+            return pytesseract.image_to_data(
+                image,
+                output_type=pytesseract.Output.DATAFRAME,
+                config="--tessdata-dir {} -l {} --psm {}".format(
+                    self.tessdata, self.model, self.psm
+                ),
+            )
+
+        self.api.SetImage(image)
+        # page 0 is reported as page_num 1, like the tesseract binary does
+        return read_tsv(self.api.GetTSVText(0))
+
+    def images_to_data(self, images) -> list:
+        """OCR several images in one go, returning a word table per image,
+        identical to what image_to_data would give for each one.
+
+        Without tesserocr, this is a single run of the tesseract binary over
+        a list of files, rather than one run (and model load) per image."""
+        if self.api is not None:
+            return [self.image_to_data(image) for image in images]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = pathlib.Path(tmpdir)
+            paths = []
+            for i, image in enumerate(images):
+                if isinstance(image, Image.Image):
+                    path = tmpdir / "{:04}.png".format(i)
+                    image.save(path)
+                else:
+                    path = pathlib.Path(image).resolve()
+                paths.append(str(path))
+            # tesseract treats a .txt input as a list of images
+            image_list = tmpdir / "images.txt"
+            image_list.write_text("\n".join(paths) + "\n")
+
+            tsv = pytesseract.image_to_data(
+                str(image_list),
+                output_type=pytesseract.Output.STRING,
+                config="--tessdata-dir {} -l {} --psm {}".format(
+                    self.tessdata, self.model, self.psm
+                ),
+            )
+        tables = [read_tsv(page) for page in split_tsv(tsv)]
+        if len(tables) != len(paths):
+            raise RuntimeError(
+                "tesseract returned {} pages for {} images".format(
+                    len(tables), len(paths)
+                )
+            )
+        return tables
+
+    def close(self):
+        if self.api is not None:
+            self.api.End()
+            self.api = None
+
+
+# one engine per process (and page segmentation mode), for the long-lived
+# pipeline and pool workers
+_engines = {}
+
+
+def get_engine(psm=None) -> TesseractEngine:
+    """This process's engine, loading the model the first time"""
+    psm = str(psm or config.OCR.PSM)
+    if psm not in _engines:
+        _engines[psm] = TesseractEngine(psm=psm)
+    return _engines[psm]
+
+
+def _image_to_data(image, psm=None):
+    return get_engine(psm).image_to_data(image)
+
+
+class OCRPool:
+    """Worker processes that each keep an engine (and so the model) loaded.
+
+    Takes PIL images or filenames, returns word tables in the same order."""
+
+    def __init__(self, processes=None, psm=None):
+        self.pool = multiprocessing.Pool(processes)
+        self.psm = psm
+
+    def map(self, images):
+        return self.pool.map(functools.partial(_image_to_data, psm=self.psm), images)
+
+    def image_to_data(self, image) -> pd.DataFrame:
+        return self.pool.apply(_image_to_data, (image, self.psm))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import pathlib
+import sys
+
+import click
+from loguru import logger
+
+from ocr_column import parse_page
+
+
+@click.command()
+@click.argument(
+    "page_dir", type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path)
+)
+@click.option("--normal", "log_level", flag_value="SUCCESS", default=True)
+@click.option("--verbose", "log_level", help="Verbose mode.", flag_value="INFO")
+@click.option("--debug", "log_level", help="Debug mode.", flag_value="DEBUG")
+def ocr_page(page_dir, log_level):
+    """Parse all five column-N-raw_ocr.csv of a page into column-N-parsed.csv
+    (and column-N-e.csv) in one go. Each column starts with a placeholder
+    for the street it continues, which stitch.py fills in."""
+
+    logger.add(sys.stderr, format="<level>{message}</level>", level=log_level)
+
+    try:
+        parse_page(page_dir)
+    except RuntimeError as e:
+        logger.error("{}", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logger.remove()
+
+    ocr_page()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import json
+import pathlib
+import sys
+
+import click
+import numpy as np
+from loguru import logger
+from scipy import ndimage
+
+from image_utils import BinaryImage
+
+# where crop_page and split_page record how each image was cut from the page
+MANIFEST = "page-transform.json"
+
+# bump this when the manifest's layout changes
+MANIFEST_VERSION = 1
+
+
+class Transform:
+    """The rotations and crops that take a source image to one cut from it
+
+    Steps are added the way they're done to a BinaryImage, rotate() and
+    crop() with the same arguments, and the whole chain is applied to the
+    source in a single nearest-neighbour resample, rather than resampling
+    again for each step. The matrix maps (x, y, 1) in the output back to
+    where it comes from in the source."""
+
+    def __init__(self, size, steps=()):
+        self.source_size = tuple(size)
+        self.size = tuple(size)
+        self.matrix = np.identity(3)
+        self.steps = []
+        for step in steps:
+            if "rotate" in step:
+                self.rotate(step["rotate"])
+            else:
+                self.crop(step["crop"])
+
+    def copy(self):
+        return Transform(self.source_size, self.steps)
+
+    def rotate(self, angle):
+        """Like BinaryImage.rotate, by angle degrees around the centre"""
+        if not angle:
+            return self
+        # kept short, the manifest is there to be edited by hand
+        angle = round(float(angle), 6)
+        wd, ht = self.size
+        cx, cy = (wd - 1) / 2, (ht - 1) / 2
+        # the same matrix and centre as scipy.ndimage.rotate
+        theta = np.deg2rad(angle)
+        c, s = np.cos(theta), np.sin(theta)
+        step = np.array(
+            [
+                [c, -s, cx - c * cx + s * cy],
+                [s, c, cy - s * cx - c * cy],
+                [0, 0, 1],
+            ]
+        )
+        self.matrix = self.matrix @ step
+        self.steps.append({"rotate": angle})
+        return self
+
+    def crop(self, box):
+        """Like BinaryImage.crop, clipped to the image"""
+        wd, ht = self.size
+        left, top, right, bot = (int(round(x)) for x in box)
+        left, right = max(0, left), min(wd, right)
+        top, bot = max(0, top), min(ht, bot)
+        step = np.array([[1, 0, left], [0, 1, top], [0, 0, 1]])
+        self.matrix = self.matrix @ step
+        self.size = (max(right - left, 0), max(bot - top, 0))
+        self.steps.append({"crop": [left, top, right, bot]})
+        return self
+
+    def apply(self, source: BinaryImage) -> BinaryImage:
+        """Cut this transform's output out of source in one resample"""
+        if source.size != self.source_size:
+            raise RuntimeError(
+                "transform is for a {}x{} image, not {}x{}".format(
+                    *self.source_size, *source.size
+                )
+            )
+        wd, ht = self.size
+        if all("crop" in x for x in self.steps):
+            # nothing to resample, just a view
+            left, top = self.matrix[:2, 2]
+            return source.crop((left, top, left + wd, top + ht))
+        # scipy works in (row, column), swap x and y over
+        matrix = self.matrix[[1, 0]][:, [1, 0]]
+        offset = self.matrix[[1, 0], 2]
+        return BinaryImage(
+            ndimage.affine_transform(
+                source.bits,
+                matrix,
+                offset,
+                output_shape=(ht, wd),
+                order=0,
+            )
+        )
+
+
+def manifest_path(page_dir: pathlib.Path) -> pathlib.Path:
+    return page_dir / MANIFEST
+
+
+def read_manifest(page_dir: pathlib.Path):
+    """The page's manifest, or None if there isn't a usable one"""
+    try:
+        manifest = json.loads(manifest_path(page_dir).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(page_dir: pathlib.Path, manifest):
+    manifest["version"] = MANIFEST_VERSION
+    path = manifest_path(page_dir)
+    tmp = path.with_name("." + path.name + ".tmp")
+    tmp.write_text(json.dumps(manifest, indent=1))
+    tmp.replace(path)
+
+
+def record_crop(page_dir: pathlib.Path, source: pathlib.Path, transform: Transform):
+    """Start the page's manifest over with how page-crop.png was cut from
+    source. Any columns recorded were cut from the old crop, so they go."""
+    write_manifest(
+        page_dir,
+        {
+            "source": source.name,
+            "size": list(transform.source_size),
+            "crop": transform.steps,
+            "columns": [],
+        },
+    )
+
+
+def crop_transform(crop: pathlib.Path, crop_size):
+    """The source image and transform that page-crop.png was cut with
+
+    Falls back on page-crop.png itself, untransformed, if there's no
+    manifest, or it doesn't match the crop (say it was replaced by hand)."""
+    page_dir = crop.parent
+    manifest = read_manifest(page_dir)
+    if manifest is not None:
+        source = page_dir / manifest["source"]
+        transform = Transform(manifest["size"], manifest["crop"])
+        if source.exists() and transform.size == tuple(crop_size):
+            return source, transform
+        logger.warning("{}: {} doesn't match the crop, ignoring it", page_dir, MANIFEST)
+    return crop, Transform(crop_size)
+
+
+def record_columns(page_dir: pathlib.Path, source: pathlib.Path, transforms):
+    """Add how each column was cut from source to the page's manifest"""
+    manifest = read_manifest(page_dir)
+    if manifest is None or manifest["source"] != source.name:
+        # cut from the crop itself, not from a page
+        manifest = {
+            "source": source.name,
+            "size": list(transforms[0].source_size),
+            "crop": [],
+        }
+    crop_steps = len(manifest["crop"])
+    manifest["columns"] = [x.steps[crop_steps:] for x in transforms]
+    write_manifest(page_dir, manifest)
+
+
+def replay(page_dir: pathlib.Path):
+    """Cut page-crop.png and every column out of the source again, each in a
+    single resample, using the manifest instead of searching again"""
+    manifest = read_manifest(page_dir)
+    if manifest is None:
+        raise RuntimeError("{}: no {} to replay".format(page_dir, MANIFEST))
+    source = BinaryImage.open(page_dir / manifest["source"])
+    crop = Transform(manifest["size"], manifest["crop"])
+    crop.apply(source).save(page_dir / "page-crop.png")
+    for i, steps in enumerate(manifest["columns"], 1):
+        column = Transform(crop.source_size, crop.steps + steps)
+        column.apply(source).save(page_dir / "column-{}.png".format(i), "PNG")
+    logger.info("{}: {} columns", page_dir, len(manifest["columns"]))
+
+
+@click.command()
+@click.argument(
+    "page_dirs",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path),
+)
+def page_transform(page_dirs):
+    """Cut page-crop.png and the column images out of each page again, from
+    the rotations, crop and column bars recorded in its page-transform.json
+
+    Edit a page's manifest (the crop box, say) and replay it instead of
+    running crop and split again."""
+
+    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+
+    for page_dir in page_dirs:
+        try:
+            replay(page_dir)
+        except RuntimeError as e:
+            logger.error("{}", e)
+
+
+if __name__ == "__main__":
+    logger.remove()
+
+    page_transform()
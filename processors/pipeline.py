@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+import multiprocessing
+import os
+import pathlib
+import sys
+import time
+
+import click
+from loguru import logger
+
+# importing the stages up front means each worker pays for
+# pandas/scipy/cv2/shapely/matplotlib once, not once per stage per page
+import auto_crop_page
+import book_store
+import ocr_column
+import page_transform
+import raw_ocr
+import reconstruct
+import split_columns
+import stitch
+import telemetry
+from rasterize import rasterize
+from image_utils import DESKEW_METHODS, ROTATE_BACKENDS, set_threads
+from stage_cache import StageCache
+
+logger.remove()
+
+COLUMNS = ocr_column.COLUMNS
+
+# version of the stitching
+STITCH_VERSION = 1
+
+
+class PageRun:
+    """Runs the stages of one page, skipping the ones whose inputs, settings
+    and version hash to what they were the last time they ran.
+
+    In plan mode nothing runs, we only collect the names of the stale stages."""
+
+    def __init__(self, page_dir: pathlib.Path, force=False, plan=False, adopt=False):
+        self.page_dir = page_dir
+        self.cache = StageCache(page_dir)
+        self.force = force
+        self.plan = plan
+        self.adopt = adopt
+        self.stale = []
+        # outputs that were, or in plan mode would be, rebuilt by this run
+        self.dirty = set()
+
+    def check(self, name, version, inputs, outputs, settings=None):
+        """Does this stage need to run? Returns (needed, cache key)"""
+        if self.plan and any(x in self.dirty or not x.exists() for x in inputs):
+            # an upstream stage is going to change this input
+            self.stale.append(name)
+            self.dirty.update(outputs)
+            return True, None
+
+        key = StageCache.key(name, version, inputs, settings)
+        if not self.force and self.cache.fresh(name, key, outputs):
+            return False, key
+        if (
+            self.adopt
+            and not self.plan
+            and not self.cache.known(name)
+            and all(x.exists() for x in outputs)
+        ):
+            # trust output that was built before there was a cache
+            self.cache.record(name, key)
+            return False, key
+
+        self.stale.append(name)
+        self.dirty.update(outputs)
+        return True, key
+
+    def stage(self, name, version, inputs, outputs, func, settings=None):
+        needed, key = self.check(name, version, inputs, outputs, settings)
+        if needed and not self.plan:
+            func()
+            self.cache.record(name, key)
+
+
+def deskew_settings(method, backend) -> dict:
+    """The crop and split stages' cache settings. The default backend is
+    left out, so pages cropped before there was a choice stay fresh."""
+    settings = {"deskew": method}
+    if backend != "scipy":
+        settings["backend"] = backend
+    return settings
+
+
+def process_page(
+    page_dir: pathlib.Path,
+    force=False,
+    plan=False,
+    adopt=False,
+    deskew_method="rotate",
+    deskew_backend="scipy",
+):
+    """Run crop -> split -> raw ocr -> column parse for one page
+
+    Returns the PageRun, which has the names of the stages that were (or,
+    when planning, would be) run."""
+
+    page = page_dir / "page.png"
+    crop = page_dir / "page-crop.png"
+    handcrop = page_dir / "page-handcrop.png"
+
+    if not page.exists() and not handcrop.exists():
+        raise RuntimeError("{}: no page.png to work from".format(page_dir))
+
+    run = PageRun(page_dir, force, plan, adopt)
+    overrides = [handcrop] if handcrop.exists() else []
+    deskew = deskew_settings(deskew_method, deskew_backend)
+
+    run.stage(
+        "crop_page",
+        auto_crop_page.STAGE_VERSION,
+        [page] + overrides if page.exists() else overrides,
+        [crop, page_dir / page_transform.MANIFEST],
+        lambda: auto_crop_page.auto_crop_page(
+            page if page.exists() else handcrop,
+            crop,
+            deskew_method=deskew_method,
+            deskew_backend=deskew_backend,
+        ),
+        settings=deskew,
+    )
+
+    columns = [page_dir / "column-{}.png".format(i) for i in COLUMNS]
+    # the columns are cut straight from page.png, by way of the crop's
+    # manifest, which changes whenever the crop does
+    run.stage(
+        "split_page",
+        split_columns.STAGE_VERSION,
+        [crop] + ([page] if page.exists() else []) + overrides,
+        columns,
+        lambda: split_columns.split_page_image(crop, deskew_method, deskew_backend),
+        settings=deskew,
+    )
+
+    model = raw_ocr.model_path()
+    raw_ocrs = [page_dir / "column-{}-raw_ocr.csv".format(i) for i in COLUMNS]
+    batch = []
+    for column, raw_ocr_csv in zip(columns, raw_ocrs):
+        name = "prepare_ocr_data/{}".format(column.stem)
+        needed, key = run.check(
+            name,
+            raw_ocr.STAGE_VERSION,
+            [column] + ([model] if model.exists() else []),
+            [raw_ocr_csv],
+            settings=raw_ocr.ocr_settings(),
+        )
+        if needed:
+            batch.append((name, key, column, raw_ocr_csv))
+    if batch and not plan:
+        # the stale columns all go to the engine together
+        names, keys, batch_columns, outputs = zip(*batch)
+        raw_ocr.save_ocr_batch(batch_columns, outputs)
+        for name, key in zip(names, keys):
+            run.cache.record(name, key)
+
+    # the columns are parsed on their own, each starting with a placeholder
+    # for whatever street it continues; finish_page fills that in
+    force_ocr = (page_dir / "force-ocr").exists()
+    run.stage(
+        "parse_columns",
+        ocr_column.STAGE_VERSION,
+        raw_ocrs,
+        [ocr_column.parsed_path(x) for x in raw_ocrs],
+        lambda: ocr_column.parse_page(page_dir, COLUMNS),
+        settings={"force": force_ocr},
+    )
+    return run
+
+
+def finish_page(page_dir: pathlib.Path, run: PageRun, html=False):
+    """Stitch the page's parsed columns onto the street the page before it
+    ends on, then build page.parquet and page.csv (and index.html)
+
+    This reads the previous page's parsed columns, so it only runs once
+    every page has been through process_page."""
+
+    parsed = [page_dir / "column-{}-parsed.csv".format(i) for i in COLUMNS]
+    ocrs = [page_dir / "column-{}-ocr.csv".format(i) for i in COLUMNS]
+    street = stitch.continued_street(page_dir, COLUMNS)
+    run.stage(
+        "stitch",
+        STITCH_VERSION,
+        parsed,
+        ocrs,
+        lambda: stitch.stitch_page(page_dir, street, COLUMNS),
+        settings={"continues": street},
+    )
+
+    page_store = page_dir / book_store.PAGE_FILE
+    run.stage(
+        "page_store",
+        book_store.STAGE_VERSION,
+        ocrs,
+        [page_store, page_dir / "page.csv"],
+        lambda: book_store.write_page(page_dir, COLUMNS),
+    )
+
+    if html:
+        columns = [page_dir / "column-{}.png".format(i) for i in COLUMNS]
+        run.stage(
+            "reconstruct",
+            reconstruct.STAGE_VERSION,
+            [page_store] + columns,
+            [page_dir / "index.html"],
+            lambda: reconstruct.render_page(page_dir),
+        )
+    return run.stale
+
+
+def run_page(args):
+    """Pool entry point, never raises so one bad page can't stop the book"""
+    page_dir, options = args
+    try:
+        with telemetry.stage("process_page", page=page_dir.name):
+            run = process_page(page_dir, **options)
+    except RuntimeError as e:
+        logger.error("{}", e)
+        return page_dir, False, None
+    except Exception:
+        logger.exception("{}: unexpected failure", page_dir)
+        return page_dir, False, None
+    return page_dir, True, run
+
+
+def run_finish(args):
+    """Pool entry point for finish_page, likewise never raises"""
+    page_dir, run, html = args
+    try:
+        with telemetry.stage("finish_page", page=page_dir.name):
+            stale = finish_page(page_dir, run, html)
+    except RuntimeError as e:
+        logger.error("{}", e)
+        return page_dir, False, []
+    except Exception:
+        logger.exception("{}: unexpected failure", page_dir)
+        return page_dir, False, []
+    return page_dir, True, stale
+
+
+def find_page_dirs(working: pathlib.Path):
+    # page directories are numbered, which leaves out the book
+    return sorted(x for x in working.iterdir() if x.is_dir() and x.name.isdigit())
+
+
+@click.command()
+@click.argument("pages", nargs=-1, type=click.Path(exists=True, path_type=pathlib.Path))
+@click.option(
+    "--working",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    default="working",
+    help="Directory of page directories, used when no pages are given.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=None,
+    help="Worker processes (default: all cores).",
+)
+@click.option("--force", is_flag=True, help="Rebuild everything, even if up to date.")
+@click.option(
+    "--plan", is_flag=True, help="List the stale pages and stages, don't run anything."
+)
+@click.option(
+    "--adopt",
+    is_flag=True,
+    help="Trust existing output that has no cache record yet instead of rebuilding it.",
+)
+@click.option("--html", is_flag=True, help="Also render each page's index.html.")
+@click.option(
+    "--deskew-method",
+    type=click.Choice(DESKEW_METHODS),
+    default="rotate",
+    help="How to find deskew angles: rotate, projection or lines.",
+)
+@click.option(
+    "--deskew-backend",
+    type=click.Choice(sorted(ROTATE_BACKENDS)),
+    default="scipy",
+    help="What rotates the image while deskewing; cv2 is quicker, and uses every core.",
+)
+@click.option(
+    "--from-pdf",
+    type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path),
+    help="Rasterize this pdf into the working directory, processing each page as soon as it's rendered.",
+)
+@click.option(
+    "--last-page", type=int, default=171, help="Last (0-based) page of --from-pdf."
+)
+@click.option(
+    "--passes", type=int, default=4, help="Parallel ghostscript passes for --from-pdf."
+)
+def pipeline(
+    pages,
+    working,
+    jobs,
+    force,
+    plan,
+    adopt,
+    html,
+    deskew_method,
+    deskew_backend,
+    from_pdf,
+    last_page,
+    passes,
+):
+    """Run every stage for the given page directories inside long-lived workers
+
+    Stages only run when the hash of their inputs, settings and version
+    changed since they last ran. Once all the pages are parsed, each page's
+    columns are stitched onto the street the previous page ends on, and the
+    changed pages are brought into the book."""
+
+    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+    # a plan doesn't run anything worth timing
+    telemetry.configure(enabled=not plan, run="{:.0f}".format(time.time()))
+
+    if from_pdf:
+        page_dirs = rasterize(from_pdf, working, 0, last_page, passes)
+    else:
+        page_dirs = list(pages) or find_page_dirs(working)
+    options = {
+        "force": force,
+        "plan": plan,
+        "adopt": adopt,
+        "deskew_method": deskew_method,
+        "deskew_backend": deskew_backend,
+    }
+
+    failed = []
+    planned = {}
+    runs = {}
+    page_count = 0
+    # the workers share the cores, rather than each one's deskew and
+    # OpenCV starting a thread per core on top of the others
+    cores = os.cpu_count() or 1
+    threads = max(1, cores // (jobs or cores))
+    # the workers are started before the pipeline's stage is opened,
+    # so their stages aren't taken to be inside it
+    with multiprocessing.Pool(
+        jobs, initializer=set_threads, initargs=(threads,)
+    ) as pool, telemetry.stage("pipeline", jobs=jobs, threads=threads):
+        for page_dir, ok, run in pool.imap_unordered(
+            run_page, ((page_dir, options) for page_dir in page_dirs)
+        ):
+            page_count += 1
+            if ok:
+                runs[page_dir] = run
+            else:
+                failed.append(page_dir)
+
+        # every page is parsed, so each can be stitched onto the one before it
+        for page_dir, ok, stale in pool.imap_unordered(
+            run_finish, ((page_dir, runs[page_dir], html) for page_dir in sorted(runs))
+        ):
+            if not ok:
+                failed.append(page_dir)
+            elif plan:
+                planned[page_dir] = stale
+            elif stale:
+                logger.success("{}: ran {}", page_dir, ", ".join(stale))
+        telemetry.note(pages=page_count)
+
+    if not plan:
+        # the book only takes in the pages whose page.parquet changed
+        for working in sorted({x.parent for x in runs}):
+            book_store.update_book(working / "book", find_page_dirs(working))
+
+    if plan:
+        for page_dir in sorted(planned):
+            if planned[page_dir]:
+                print("{}: {}".format(page_dir, ", ".join(planned[page_dir])))
+        print(
+            "{} of {} pages are stale".format(
+                sum(1 for x in planned.values() if x), page_count
+            )
+        )
+
+    if failed:
+        logger.warning(
+            "{} of {} pages failed: {}",
+            len(failed),
+            page_count,
+            ", ".join(sorted(x.name for x in failed)),
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    pipeline()
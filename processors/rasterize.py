@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+from loguru import logger
+from PIL import Image, ImageOps
+
+logger.remove()
+
+RESOLUTION = 600
+
+
+def page_ranges(first: int, last: int, passes: int):
+    """Split first..last (inclusive) into at most `passes` contiguous ranges"""
+    count = last - first + 1
+    passes = max(1, min(passes, count))
+    step, extra = divmod(count, passes)
+    start = first
+    for i in range(passes):
+        end = start + step + (1 if i < extra else 0) - 1
+        yield start, end
+        start = end + 1
+
+
+def start_pass(pdf: pathlib.Path, first: int, last: int, outdir: pathlib.Path):
+    """Start a ghostscript pass rendering pages first..last (0-based) into outdir"""
+    return subprocess.Popen(
+        [
+            "gs",
+            "-q",
+            "-dNOPAUSE",
+            "-dBATCH",
+            "-dSAFER",
+            "-sDEVICE=pnggray",
+            "-r{}".format(RESOLUTION),
+            "-dFirstPage={}".format(first + 1),
+            "-dLastPage={}".format(last + 1),
+            "-sOutputFile={}".format(outdir / "%04d.png"),
+            str(pdf),
+        ]
+    )
+
+
+class RenderPass:
+    """A running ghostscript process and the pages of its range we've collected"""
+
+    def __init__(self, proc, outdir: pathlib.Path, start: int, end: int):
+        self.proc = proc
+        self.outdir = outdir
+        self.start = start
+        self.end = end
+        self.next_page = start
+
+    def output(self, page: int) -> pathlib.Path:
+        # ghostscript numbers the output of each run from 1
+        return self.outdir / "{:04}.png".format(page - self.start + 1)
+
+    def finished(self, done: bool):
+        """Yield (file, page) for every page that is completely written.
+
+        Pages come out in order, so a page is complete once the next one
+        has been started, or the process has exited."""
+        while self.next_page <= self.end:
+            rendered = self.output(self.next_page)
+            if not rendered.exists():
+                break
+            if not done and not self.output(self.next_page + 1).exists():
+                break
+            yield rendered, self.next_page
+            self.next_page += 1
+
+
+def normalize(rendered: pathlib.Path, output: pathlib.Path):
+    """Stretch to the full grey range and reduce to two colors, like
+    `convert +dither -colors 2 -colorspace gray -normalize` used to"""
+    im = ImageOps.autocontrast(Image.open(rendered).convert("L"))
+    im = im.point(lambda p: 255 if p >= 128 else 0)
+
+    # write beside the target and rename, so nobody sees half a page
+    tmp = output.with_name(output.name + ".tmp")
+    im.save(tmp, "PNG")
+    os.replace(tmp, output)
+    rendered.unlink()
+
+
+def rasterize(
+    pdf: pathlib.Path, working: pathlib.Path, first: int, last: int, passes=4
+):
+    """Render pages first..last of the pdf into working/NNN/page.png
+
+    Each of the `passes` ghostscript processes renders a contiguous range
+    of pages in one go. Ghostscript writes pages in order, so a page is finished
+    once the next one appears (or the pass exits); finished pages are moved
+    into place and their directory yielded straight away."""
+
+    working.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=working) as tmpdir:
+        running = []
+        try:
+            for start, end in page_ranges(first, last, passes):
+                outdir = pathlib.Path(tmpdir) / "{:03}".format(start)
+                outdir.mkdir()
+                running.append(
+                    RenderPass(start_pass(pdf, start, end, outdir), outdir, start, end)
+                )
+
+            while running:
+                for render in list(running):
+                    done = render.proc.poll() is not None
+                    if done and render.proc.returncode:
+                        raise RuntimeError(
+                            "ghostscript failed rendering pages {}-{}".format(
+                                render.start, render.end
+                            )
+                        )
+
+                    for rendered, page in render.finished(done):
+                        page_dir = working / "{:03}".format(page)
+                        page_dir.mkdir(exist_ok=True)
+                        normalize(rendered, page_dir / "page.png")
+                        logger.info("{}: rendered", page_dir)
+                        yield page_dir
+
+                    if done:
+                        if render.next_page <= render.end:
+                            raise RuntimeError(
+                                "ghostscript stopped before page {}".format(
+                                    render.next_page
+                                )
+                            )
+                        running.remove(render)
+                time.sleep(0.2)
+        finally:
+            for render in running:
+                if render.proc.poll() is None:
+                    render.proc.kill()
+                    render.proc.wait()
+
+
+@click.command()
+@click.argument("pdf", type=click.Path(exists=True, path_type=pathlib.Path))
+@click.argument(
+    "working",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    default="working",
+)
+@click.option("--first", type=int, default=0, help="First page (0-based).")
+@click.option("--last", type=int, required=True, help="Last page (0-based).")
+@click.option("--passes", type=int, default=4, help="Parallel ghostscript passes.")
+def rasterize_pdf(pdf, working, first, last, passes):
+    """Render the pdf into working/NNN/page.png with a few parallel ghostscript passes"""
+
+    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+
+    for page_dir in rasterize(pdf, working, first, last, passes):
+        pass
+
+
+if __name__ == "__main__":
+    rasterize_pdf()
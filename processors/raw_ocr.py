@@ -1,49 +1,190 @@
 #!/usr/bin/env python
 
 import csv
+import os
 import pathlib
 import sys
 
 import click
 import pandas as pd
-import pytesseract
 from loguru import logger
 from PIL import Image, ImageDraw
 
+import telemetry
+from image_utils import as_binary
+from ocr_engine import OCRPool, get_engine
+from slip_index import row_boxes
+from word_table import word_frame
 
 sys.path.append(str(pathlib.Path(__file__).parent.parent))
 # print(sys.path)
 import config
 
+# stage cache version, bump to force a re-OCR of everything
+STAGE_VERSION = 1
 
-def prepare_ocr_data(filename: str) -> pd.DataFrame:
 
-    # Get verbose data including boxes, confidences, line and page numbers
+def ocr_settings() -> dict:
+    """The config.OCR settings that change what the OCR produces
 
-    ocr_data = pytesseract.image_to_data(
-        Image.open(filename),
-        output_type=pytesseract.Output.DATAFRAME,
-        config="--tessdata-dir {} -l {} --psm {}".format(
-            config.OCR.TESSDATADIR, config.OCR.MODEL, config.OCR.PSM
-        ),  # Assume a single uniform block of text.
-    ).dropna()
+    Not where the model lives: the model file itself is one of the stage's
+    inputs, so its bytes are hashed, and a clone of the repo somewhere else
+    keeps its OCR."""
+    return {
+        "model": config.OCR.MODEL,
+        "psm": config.OCR.PSM,
+    }
 
+
+def model_path() -> pathlib.Path:
+    return pathlib.Path(config.OCR.TESSDATADIR) / "{}.traineddata".format(
+        config.OCR.MODEL
+    )
+
+
+def prepare_ocr_data(image) -> pd.DataFrame:
+    """OCR a column (PIL image or filename) into a word table"""
+
+    with telemetry.stage(
+        "prepare_ocr_data",
+        page=telemetry.page_of(image),
+        image=telemetry.name_of(image),
+        images=1,
+    ):
+        # Get verbose data including boxes, confidences, line and page numbers
+        # (the engine is configured to assume a single uniform block of text.)
+        ocr_data = get_engine().image_to_data(image).dropna()
+        telemetry.note(words=len(ocr_data))
+
+        ocr_data["right"] = ocr_data["left"] + ocr_data["width"]
+        ocr_data["bot"] = ocr_data["top"] + ocr_data["height"]
+        return ocr_data
+
+
+def prepare_ocr_batch(images) -> list:
+    """OCR several columns (PIL images or filenames) with a single engine
+    submission, returning the same word tables prepare_ocr_data would"""
+
+    # a batch may be a chunk of pages, in which case it isn't any one page's
+    pages = {telemetry.page_of(x) for x in images}
+    with telemetry.stage(
+        "prepare_ocr_data",
+        page=pages.pop() if len(pages) == 1 else None,
+        images=len(images),
+    ):
+        tables = []
+        for ocr_data in get_engine().images_to_data(images):
+            ocr_data = ocr_data.dropna()
+            ocr_data["right"] = ocr_data["left"] + ocr_data["width"]
+            ocr_data["bot"] = ocr_data["top"] + ocr_data["height"]
+            tables.append(ocr_data)
+        telemetry.note(words=sum(len(x) for x in tables))
+        return tables
+
+
+def row_strips(image, pad=4):
+    """Cut a column into one strip per row, returning (top, strip) pairs.
+
+    Each strip gets a few pixels of margin above and below, since tesseract
+    does badly with glyphs that touch the edge of the image, but only as
+    far as the white between it and the next row. Rows cut evenly out of a
+    run of rows stuck together have no white between them to take."""
+    wd, ht = image.size
+    edges = [
+        (int(round(top)), int(round(bot)))
+        for left, top, right, bot in row_boxes(as_binary(image))
+    ]
+    strips = []
+    for i, (top, bot) in enumerate(edges):
+        above = edges[i - 1][1] if i else 0
+        below = edges[i + 1][0] if i + 1 < len(edges) else ht
+        top = max(above, top - pad)
+        bot = min(below, bot + pad)
+        strips.append((top, image.crop((0, top, wd, bot))))
+    return strips
+
+
+def prepare_ocr_rows(image, processes=None, pool=None) -> pd.DataFrame:
+    """OCR a column (PIL image or filename) one row at a time, with the rows
+    spread over a pool of workers, into the same word table as prepare_ocr_data.
+
+    Every strip is a single line of text, so each row becomes line n+1
+    of a single block and paragraph, with boxes in column coordinates.
+
+    Pass an OCRPool (made with the row psm) to reuse its workers, and their
+    loaded models, from column to column. Otherwise one is started for this
+    column, with no more workers than cores."""
+
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    image = image.convert("L")
+
+    strips = row_strips(image)
+    if not strips:
+        return prepare_ocr_data(image)
+
+    images = [strip for top, strip in strips]
+    if pool is not None:
+        tables = pool.map(images)
+    else:
+        processes = min(processes or os.cpu_count(), len(strips))
+        with OCRPool(processes, psm=config.OCR.ROW_PSM) as pool:
+            tables = pool.map(images)
+
+    rows = []
+    for line, ((top, strip), ocr_data) in enumerate(zip(strips, tables), 1):
+        ocr_data = ocr_data.dropna()
+        if ocr_data.empty:
+            continue
+        ocr_data = ocr_data.assign(
+            block_num=1, par_num=1, line_num=line, top=ocr_data["top"] + top
+        )
+        rows.append(ocr_data)
+
+    if not rows:
+        return prepare_ocr_data(image)
+    ocr_data = pd.concat(rows, ignore_index=True)
     ocr_data["right"] = ocr_data["left"] + ocr_data["width"]
     ocr_data["bot"] = ocr_data["top"] + ocr_data["height"]
     return ocr_data
 
 
-@click.command()
-@click.argument("filename", type=click.Path(exists=True))
-@click.argument("output", type=click.Path())
-@click.option("--debug_image", type=click.Path())
-def ocr_column(filename, output, debug_image=None):
-    """get our best information"""
-    logger.add(
-        sys.stderr, format="<level>{message}</level>", backtrace=True, level="INFO"
-    )
+def raw_ocr_path(filename) -> pathlib.Path:
+    """column-N.png -> column-N-raw_ocr.csv"""
+    filename = pathlib.Path(filename)
+    return filename.with_name(filename.stem + "-raw_ocr.csv")
+
+
+def save_ocr_batch(filenames, outputs=None) -> list:
+    """OCR all the columns in one go, and write each word table out
+    to its column-N-raw_ocr.csv (or the corresponding output)"""
+
+    if outputs is None:
+        outputs = [raw_ocr_path(x) for x in filenames]
+    tables = prepare_ocr_batch(filenames)
+    for filename, output, ocr_data in zip(filenames, outputs, tables):
+        write_ocr_data(filename, output, ocr_data)
+    return tables
+
+
+def save_ocr_data(
+    filename, output, rows=False, processes=None, pool=None
+) -> pd.DataFrame:
+    """OCR filename, log the confidence and write the word table to output
+
+    With rows, OCR it a row at a time across processes, or pool's workers
+    (see prepare_ocr_rows)"""
+
+    if rows:
+        ocr_data = prepare_ocr_rows(filename, processes, pool)
+    else:
+        ocr_data = prepare_ocr_data(filename)
+    write_ocr_data(filename, output, ocr_data)
+    return ocr_data
+
 
-    ocr_data = prepare_ocr_data(filename)
+def write_ocr_data(filename, output, ocr_data: pd.DataFrame):
+    """log the confidence and write the word table to output"""
 
     conf = ocr_data["conf"].mean()
     # logger.info("{}: {")
@@ -69,7 +210,32 @@ def ocr_column(filename, output, debug_image=None):
             ocr_data["conf"].std(),
         )
 
-    ocr_data.to_csv(output, quoting=csv.QUOTE_NONNUMERIC)
+    word_frame(ocr_data).to_csv(output, quoting=csv.QUOTE_NONNUMERIC)
+
+
+@click.command()
+@click.argument("filename", type=click.Path(exists=True))
+@click.argument("output", type=click.Path())
+@click.option("--debug_image", type=click.Path())
+@click.option(
+    "--rows",
+    is_flag=True,
+    help="OCR the column a row at a time, in parallel, for a quick re-OCR.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=None,
+    help="Worker processes for --rows (default: all cores).",
+)
+def ocr_column(filename, output, debug_image=None, rows=False, jobs=None):
+    """get our best information"""
+    logger.add(
+        sys.stderr, format="<level>{message}</level>", backtrace=True, level="INFO"
+    )
+
+    ocr_data = save_ocr_data(filename, output, rows=rows, processes=jobs)
 
     if debug_image:
         # output a marked-up debug image
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import pathlib
+import sys
+
+import click
+from loguru import logger
+
+from raw_ocr import save_ocr_batch
+
+
+@click.command()
+@click.argument(
+    "filenames",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, path_type=pathlib.Path),
+)
+def ocr_batch(filenames):
+    """OCR all the given column images (say, the five columns of a page, or
+    a chunk of pages) in one submission to the engine, writing each one's
+    word table to column-N-raw_ocr.csv beside it."""
+    logger.add(
+        sys.stderr, format="<level>{message}</level>", backtrace=True, level="INFO"
+    )
+
+    save_ocr_batch(list(filenames))
+
+
+if __name__ == "__main__":
+    logger.remove()
+
+    ocr_batch()
@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
-import ast
 import pathlib
 
 import click
 import jinja2
 import pandas
 
+import telemetry
+from book_store import load_page
+
 TEMPLATES_DIR = pathlib.Path(__file__).parent / "templates"
 
+# bump this when the rendered html changes
+STAGE_VERSION = 1
+
 
 class Column:
     def __init__(self, col_id: int, data_table: pandas.DataFrame):
@@ -43,15 +48,7 @@ class Column:
 
 class Page:
     def __init__(self, pagedir: pathlib.Path):
-        self.data_table = pandas.read_csv(
-            pagedir / "page.csv",
-            converters={
-                "new_bbox": ast.literal_eval,
-                "old_bbox": ast.literal_eval,
-                "new": str,
-                "old": str,
-            },
-        )
+        self.data_table = load_page(pagedir)
         self.columns = []
         for page_col_id, data_table in self.data_table.groupby(["page", "column"]):
             page_id, col_id = page_col_id
@@ -69,11 +66,19 @@ class Page:
 def reconstruct(infile: pathlib.Path):
     """Using a CSV file, reconstruct what the column may have looked like"""
 
-    page = Page(infile)
+    render_page(infile)
+
+
+def render_page(pagedir: pathlib.Path):
+    """Write index.html and the per-column correction pages for pagedir"""
+
+    with telemetry.stage("reconstruct", page=pagedir.name):
+        page = Page(pagedir)
+        telemetry.note(rows=len(page.data_table), columns=len(page.columns))
 
-    (infile / "index.html").write_text(page.render())
-    for column in page.columns:
-        (infile / column.correction_href).write_text(column.render())
+        (pagedir / "index.html").write_text(page.render())
+        for column in page.columns:
+            (pagedir / column.correction_href).write_text(column.render())
 
 
 if __name__ == "__main__":
@@ -1,64 +1,291 @@
 # /usr/bin/env python3
+import csv
+import json
+import multiprocessing
+import os
 import pathlib
+import re
 
+import click
 import numpy as np
-import pandas
 
+import telemetry
+
+# each page's stats, kept in the working directory between reports
+STATS_FILE = ".report-stats.json"
+
+# bump this when page_stats changes what it works out
+STATS_VERSION = 1
+
+# the files page_stats reads, or checks for. A page's stats are good for as
+# long as the size and modification time of each of these stay the same
+STATS_FILES = re.compile(
+    r"page\.parquet|page\.csv|page-crop\.png|page-handcrop\.png"
+    r"|column-\d+\.png|column-\d+-e\.csv|column-\d+-raw_ocr\.csv"
+)
+
+
+def get_confidence_std(page_dir):
+    # imported here, so a report where no page changed never loads
+    # pandas and pyarrow and comes back straight away
+    import pandas
+    from book_store import load_page
 
-def get_csv_confidence_std(page):
     try:
-        d = pandas.read_csv(page)
-    except pandas.errors.ParserError:
-        print("error in", page)
-        return 0
+        d = load_page(page_dir, columns=["new_conf", "old_conf"])
+    except (pandas.errors.ParserError, OSError, ValueError):
+        print("error in", page_dir)
+        return 0, 0, 0
     try:
-        return min(d["new_conf"].mean(), d["old_conf"].mean()), max(
-            d["new_conf"].std(), d["old_conf"].std()
+        return (
+            min(d["new_conf"].mean(), d["old_conf"].mean()),
+            max(d["new_conf"].std(), d["old_conf"].std()),
+            len(d),
         )
     except KeyError:
-        print("error in", page)
-        return 0
+        print("error in", page_dir)
+        return 0, 0, 0
+
+
+def count_rows(filename: pathlib.Path) -> int:
+    """Data rows in a csv, without parsing the fields"""
+    with open(filename, newline="") as fp:
+        return max(sum(1 for _ in csv.reader(fp)) - 1, 0)
+
+
+def page_files(page_dir: pathlib.Path) -> dict:
+    """The size and modification time of each file page_stats looks at,
+    from a single listing of the page directory"""
+    with os.scandir(page_dir) as entries:
+        return {
+            entry.name: [entry.stat().st_size, entry.stat().st_mtime_ns]
+            for entry in entries
+            if STATS_FILES.fullmatch(entry.name)
+        }
+
+
+def page_stats(page_dir: pathlib.Path, files) -> dict:
+    """How far the page got, and how well its OCR went"""
+    stats = {
+        "handcrop": "page-handcrop.png" in files,
+        "crop": "page-crop.png" in files,
+        "split": "column-1.png" in files,
+        "ocr": "page.csv" in files,
+        "conf": 0,
+        "std": 0,
+        "rows": 0,
+    }
+    if stats["ocr"]:
+        stats["conf"], stats["std"], stats["rows"] = get_confidence_std(page_dir)
+
+    # the words the column parser couldn't use, out of all the words OCR'd
+    words = errors = 0
+    for name in files:
+        if name.endswith("-raw_ocr.csv"):
+            words += count_rows(page_dir / name)
+        elif name.endswith("-e.csv"):
+            errors += count_rows(page_dir / name)
+    stats["words"] = words
+    stats["errors"] = errors
+    stats["error_rate"] = errors / words if words else 0
+    return stats
+
+
+def _page_stats(args):
+    page_dir, files = args
+    return page_dir.name, page_stats(page_dir, files)
+
+
+def stats_index(working: pathlib.Path, page_dirs, jobs=None) -> dict:
+    """Every page's stats, only working out again those of the pages
+    whose files changed since the last report"""
+
+    index_file = working / STATS_FILE
+    try:
+        index = json.loads(index_file.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        index = {}
+    if index.get("version") != STATS_VERSION:
+        index = {"version": STATS_VERSION, "pages": {}}
+
+    known = index["pages"]
+    pages = {}
+    stale = []
+    for page_dir in page_dirs:
+        files = page_files(page_dir)
+        entry = known.get(page_dir.name)
+        if entry is not None and entry["files"] == files:
+            pages[page_dir.name] = entry
+        else:
+            pages[page_dir.name] = {"files": files}
+            stale.append((page_dir, files))
+
+    if len(stale) > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(_page_stats, stale)
+    else:
+        results = [_page_stats(x) for x in stale]
+    for name, stats in results:
+        pages[name]["stats"] = stats
 
+    if stale or pages.keys() != known.keys():
+        index["pages"] = pages
+        tmp = index_file.with_name(index_file.name + ".tmp")
+        tmp.write_text(json.dumps(index, sort_keys=True))
+        tmp.replace(index_file)
+    return {name: entry["stats"] for name, entry in pages.items()}
 
-def handcrop_info(d):
-    if (d / "page-handcrop.png").exists():
+
+def timing_report(records):
+    """The slowest stages and pages, and what the last pipeline run waited on"""
+
+    latest = telemetry.latest(records)
+    if not latest:
+        return
+
+    by_stage = {}
+    for record in latest:
+        by_stage.setdefault(record["stage"], []).append(record)
+    print("Slowest stages (latest run of each page):")
+    totals = sorted(
+        ((sum(x["wall"] for x in runs), name) for name, runs in by_stage.items()),
+        reverse=True,
+    )
+    for total, name in totals[:10]:
+        runs = by_stage[name]
+        print(
+            "\t{:8.1f}s {:<18} {:>5} runs, {:.2f}s max, {:.0f}% cpu, "
+            "{:.0f}MB process peak, {:.0f}MB growth".format(
+                total,
+                name,
+                len(runs),
+                max(x["wall"] for x in runs),
+                100 * sum(x["cpu"] for x in runs) / total if total else 0,
+                max(x["peak_rss_mb"] for x in runs),
+                # records from before growth was kept don't have it
+                max(x.get("rss_growth_mb", 0) for x in runs),
+            )
+        )
+
+    pages = {}
+    for record in latest:
+        if record["parent"] is None:
+            pages.setdefault(record["page"], []).append(record)
+    print("Slowest pages:")
+    page_times = sorted(
+        ((sum(x["wall"] for x in runs), page) for page, runs in pages.items()),
+        reverse=True,
+    )
+    for total, page in page_times[:10]:
+        print("\t{:8.1f}s {} ({})".format(total, page, breakdown(pages[page])))
+
+    runs = [x for x in records if x["stage"] == "pipeline"]
+    if not runs:
+        return
+    pipeline = max(runs, key=lambda x: x["ts"])
+    # the pipeline waits for every page's process_page before any
+    # finish_page starts, so the slowest of each pass is the critical path
+    path = []
+    for pass_stage in ("process_page", "finish_page"):
+        done = [
+            x
+            for x in records
+            if x["run"] == pipeline["run"] and x["stage"] == pass_stage
+        ]
+        if done:
+            path.append(max(done, key=lambda x: x["wall"]))
+    print(
+        "Last pipeline run: {:.1f}s for {} pages, critical path {:.1f}s:".format(
+            pipeline["wall"], pipeline.get("pages", 0), sum(x["wall"] for x in path)
+        )
+    )
+    for record in path:
+        children = [x for x in records if x["parent"] == record["id"]]
+        print(
+            "\t{:8.1f}s {} {} ({})".format(
+                record["wall"], record["stage"], record["page"], breakdown(children)
+            )
+        )
+
+
+def breakdown(records) -> str:
+    """stage 1.2s, stage 0.3s, ... slowest first"""
+    times = {}
+    for record in records:
+        times[record["stage"]] = times.get(record["stage"], 0) + record["wall"]
+    return ", ".join(
+        "{} {:.1f}s".format(name, wall)
+        for name, wall in sorted(times.items(), key=lambda x: -x[1])
+    )
+
+
+def handcrop_info(stats):
+    if stats["handcrop"]:
         return "*"
     else:
         return ""
 
 
-def report():
-    working = pathlib.Path("working")
+@click.command()
+@click.option(
+    "--working",
+    type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path),
+    default="working",
+    help="Directory of page directories.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=None,
+    help="Worker processes for the pages that changed (default: all cores).",
+)
+def report(working, jobs):
+    """How far each page got, and which pages have the best/worst OCR"""
 
-    page_dirs = [x for x in working.iterdir() if x.is_dir()]
+    # page directories are numbered, which leaves out the book
+    page_dirs = [x for x in working.iterdir() if x.is_dir() and x.name.isdigit()]
     page_dirs.sort()
+    index = stats_index(working, page_dirs, jobs)
+    stats = {x: index[x.name] for x in page_dirs}
 
-    fails = {x for x in page_dirs if (x / "page.csv").exists()}
+    fails = {x for x in page_dirs if stats[x]["ocr"]}
 
-    conf_std_page = [(get_csv_confidence_std(x / "page.csv"), x) for x in fails]
-    confidences = [(n[0], x) for n, x in conf_std_page]
+    confidences = [(stats[x]["conf"], x) for x in fails]
     confidences.sort()
     print("Least confident pages (* handcropped):")
     for conf, pagedir in confidences[:20]:
-        print("\t{:.02f} {} {}".format(conf, pagedir, handcrop_info(pagedir)))
+        print("\t{:.02f} {} {}".format(conf, pagedir, handcrop_info(stats[pagedir])))
 
     print("Most confident pages (* handcropped):")
     for conf, pagedir in confidences[-10:]:
-        print("\t{:.02f} {} {}".format(conf, pagedir, handcrop_info(pagedir)))
+        print("\t{:.02f} {} {}".format(conf, pagedir, handcrop_info(stats[pagedir])))
 
-    deviances = [(n[1], x) for n, x in conf_std_page]
+    deviances = [(stats[x]["std"], x) for x in fails]
     deviances.sort(reverse=True)
     print("Most deviant pages (* handcropped):")
     for conf, pagedir in deviances[:20]:
-        print("\t{:.02f} {} {}".format(conf, pagedir, handcrop_info(pagedir)))
+        print("\t{:.02f} {} {}".format(conf, pagedir, handcrop_info(stats[pagedir])))
+
+    error_rates = [(stats[x]["error_rate"], x) for x in fails]
+    error_rates.sort(reverse=True)
+    print("Most OCR errors, as a share of words (* handcropped):")
+    for rate, pagedir in error_rates[:10]:
+        print(
+            "\t{:.02f} {} {} ({} of {} words)".format(
+                rate,
+                pagedir,
+                handcrop_info(stats[pagedir]),
+                stats[pagedir]["errors"],
+                stats[pagedir]["words"],
+            )
+        )
 
     for conf, pagedir in confidences:
         if conf == 0:
             print(pagedir / "*.csv", end="  ")
 
-    failed_crops = [
-        x for x in page_dirs if x not in fails and not (x / "page-crop.png").exists()
-    ]
+    failed_crops = [x for x in page_dirs if x not in fails and not stats[x]["crop"]]
     fails.update(failed_crops)
     if failed_crops:
         print(
@@ -70,9 +297,7 @@ def report():
             "\t consider manually cropping these pages and saving as 'page-handcrop.png'"
         )
 
-    failed_to_split = [
-        x for x in page_dirs if x not in fails and not (x / "column-1.png").exists()
-    ]
+    failed_to_split = [x for x in page_dirs if x not in fails and not stats[x]["split"]]
     failed_to_split.sort()
     fails.update(failed_to_split)
     if failed_to_split:
@@ -85,9 +310,7 @@ def report():
             "\t consider manually cropping or cleaning up these pages and saving as 'page-handcrop.png'"
         )
 
-    failed_to_ocr = [
-        x for x in page_dirs if x not in fails and not (x / "page.csv").exists()
-    ]
+    failed_to_ocr = [x for x in page_dirs if x not in fails and not stats[x]["ocr"]]
     failed_to_ocr.sort()
     fails.update(failed_to_ocr)
     if failed_to_ocr:
@@ -100,6 +323,8 @@ def report():
             "\t usually this is because the OCR was unable to identify a street name, consider manually splitting into columns"
         )
 
+    timing_report(telemetry.read_records())
+
     if False:
         # we should figure out how to detect OCR
         # that could be improved
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import pathlib
+import sys
+
+import click
+import cv2 as cv
+import numpy as np
+import pandas as pd
+from loguru import logger
+from scipy.ndimage import label
+
+import telemetry
+from image_utils import BinaryImage, as_binary
+
+# the columns of a column-N-slips.csv, one row per half slip, in column
+# coordinates. side is 0 for the left half (or the whole slip, if there's no
+# centre line to split it on) and 1 for the right
+SLIP_COLUMNS = ["row", "side", "left", "top", "right", "bot"]
+
+# rows no taller than this aren't slips, just specks between them
+MIN_ROW_HEIGHT = 10
+
+# auto_crop's structuring elements: join up the type along each line,
+# then clear away anything smaller than a slip
+CLOSING = np.ones((1, 101), np.uint8)
+OPENING = np.ones((51, 51), np.uint8)
+
+
+def runs(x: np.ndarray):
+    """The start, end (exclusive) and value of each run of equal values in
+    a 1d array, found from where it changes rather than one cell at a time"""
+    x = np.asarray(x)
+    if not len(x):
+        return np.zeros(0, int), np.zeros(0, int), x[:0]
+    change = np.flatnonzero(x[1:] != x[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(x)]))
+    return starts, ends, x[starts]
+
+
+def row_boxes(column: BinaryImage, threshold=10) -> list:
+    """The (left, top, right, bottom) box of each row of the column
+
+    Runs of rows with more than threshold black pixels are slips, unless
+    they're shorter than 17 pixels. A run that's a whole number of median
+    runs long, give or take 5%, is that many slips stuck together, and is
+    cut evenly."""
+    width, height = column.size
+    starts, ends, ink = runs(column.histogram(axis=1) > threshold)
+    lengths = ends - starts
+    if not len(lengths):
+        return []
+    # the median run, ink or whitespace, ought to be about one address row
+    median = np.median(lengths)
+    remainder = lengths % median
+    slop = np.minimum(median - remainder, remainder)
+    stuck = (lengths > median * 1.1) & (slop < median * 0.05)
+
+    boxes = []
+    for top, length, stuck_together in zip(
+        starts[ink].tolist(), lengths[ink].tolist(), stuck[ink].tolist()
+    ):
+        if length < 17:
+            continue
+        if stuck_together:
+            slips = int(round(length / median))
+            step = length / slips
+            for i in range(slips):
+                boxes.append((0, top + step * i, width, top + step * (i + 1)))
+        else:
+            boxes.append((0, top, width, top + length))
+    return boxes
+
+
+def pixel_rows(boxes, height):
+    """The top and bottom pixel rows of each box, rounded and clipped as
+    BinaryImage.crop does"""
+    edges = np.rint([(box[1], box[3]) for box in boxes]).astype(int).reshape(-1, 2)
+    return np.clip(edges, 0, height).T
+
+
+def centre_lines(column: BinaryImage, boxes, thresh=5) -> list:
+    """The (left, right) of the line down the middle of each row, or None
+    if it doesn't have one
+
+    Looks at every row at once: each row's column histogram comes from a
+    single reduceat down the column, and the runs of ink
+    across each row are found by where those histograms cross thresh.
+    A line is a run starting within 5% of the middle, no more than 12
+    pixels wide, with black in at least 78% as many of its pixel rows as
+    the fullest column of the row has."""
+    width, height = column.size
+    if not len(boxes):
+        return []
+    tops, bots = pixel_rows(boxes, height)
+    heights = bots - tops
+
+    # sums from each top to its bottom, and (thrown away) from each bottom
+    # to the next top, with a white row below so the last bottom is in range
+    padded = np.zeros((height + 1, width), np.uint8)
+    padded[:-1] = column.bits
+    edges = np.stack([tops, bots], axis=1).ravel()
+    hist = np.add.reduceat(padded, edges, axis=0, dtype=np.int32)[::2]
+    hist[heights == 0] = 0
+
+    ink = hist > thresh
+    before = np.zeros_like(ink)
+    before[:, 1:] = ink[:, :-1]
+    after = np.zeros_like(ink)
+    after[:, :-1] = ink[:, 1:]
+    row, start = np.nonzero(ink & ~before)
+    # a run's end is the first end at or after its start, they can't
+    # run past the end of the row
+    flat_ends = np.flatnonzero(ink & ~after)
+    end = flat_ends[np.searchsorted(flat_ends, row * width + start)] % width + 1
+
+    near = np.abs(start - width / 2) < width / 20
+    narrow = end - start <= 12
+    row, start, end = row[near & narrow], start[near & narrow], end[near & narrow]
+
+    across = np.zeros((len(boxes), width + 1), np.int64)
+    np.cumsum(hist, axis=1, out=across[:, 1:])
+    fill = (across[row, end] - across[row, start]) / ((end - start) * heights[row])
+    fullest = hist.max(axis=1)
+
+    lines = [None] * len(boxes)
+    best = {}
+    for r, s, e, f in zip(row.tolist(), start.tolist(), end.tolist(), fill.tolist()):
+        h = heights[r]
+        filled = np.count_nonzero(column.bits[tops[r] : bots[r], s:e].any(axis=1))
+        # at least 78% of a filled line, relative to the slip content
+        if (filled / h) / (fullest[r] / h) <= 0.78:
+            continue
+        if r in best:
+            logger.debug("row {}: more than one centre line, taking the thickest", r)
+            if f <= best[r]:
+                continue
+        best[r] = f
+        lines[r] = (s, e)
+    return lines
+
+
+def halves(box, line):
+    """The boxes either side of a row's centre line, in the row's
+    coordinates, or just the whole row if it has no line"""
+    left, top, right, bot = box
+    width, height = right - left, int(round(bot)) - int(round(top))
+    if line is None:
+        return [(0, 0, width, height)]
+    return [(0, 0, line[0] - 1, height), (line[1] + 1, 0, width, height)]
+
+
+def end_points(s, std_below_mean=-1.5):
+    """The first and last cell above std_below_mean, as auto_crop finds
+    them. If none are, it's the last cell, and the last cell again."""
+    above = np.flatnonzero(s > std_below_mean)
+    last = len(s) - 1
+    i = above[0] if len(above) else last
+    after = above[above > i]
+    if len(after):
+        j = after[-1]
+    else:
+        j = i + 1 if i < last else last
+    return int(i), int(j)
+
+
+def largest_component_box(slip: BinaryImage):
+    """The box auto_crop would crop the slip to: around the largest patch of
+    white once the type is closed up and the speckles opened away"""
+    # cv2's flat morphology ignores what's past the edge, which comes to
+    # the same as scipy's reflected edges for a min or max, and is quicker
+    im = cv.morphologyEx(slip.grey(), cv.MORPH_CLOSE, CLOSING)
+    t, im = cv.threshold(im, 0, 1, cv.THRESH_OTSU)
+    im = cv.morphologyEx(im, cv.MORPH_OPEN, OPENING)
+
+    lbl, ncc = label(im)
+    if ncc:
+        sizes = np.bincount(lbl.ravel())
+        sizes[0] = 0
+        im = (lbl == sizes.argmax()).astype(im.dtype)
+
+    col_sum = np.sum(im, axis=0)
+    row_sum = np.sum(im, axis=1)
+    col_standard = (col_sum - col_sum.mean()) / (col_sum.std() + 0.000001)
+    row_standard = (row_sum - row_sum.mean()) / (row_sum.std() + 0.000001)
+
+    x1, x2 = end_points(col_standard)
+    y1, y2 = end_points(row_standard)
+    return x1, y1, x2, y2
+
+
+def slip_index(column, threshold=10, thresh=5) -> pd.DataFrame:
+    """Every slip of the column, as a box in the column's coordinates
+
+    The rows, the centre lines splitting them and the crop of each half
+    are all worked out on the column's bits, without cutting an image
+    for any of them."""
+    column = as_binary(column)
+    boxes = row_boxes(column, threshold)
+    lines = centre_lines(column, boxes, thresh)
+
+    slips = []
+    for row, (box, line) in enumerate(zip(boxes, lines)):
+        top = int(round(box[1]))
+        if int(round(box[3])) - top <= MIN_ROW_HEIGHT:
+            continue
+        strip = column.crop(box)
+        for side, half in enumerate(halves(box, line)):
+            x1, y1, x2, y2 = largest_component_box(strip.crop(half))
+            left = max(half[0], 0)
+            slips.append((row, side, left + x1, top + y1, left + x2, top + y2))
+    return pd.DataFrame(slips, columns=SLIP_COLUMNS)
+
+
+def slips_path(column_png: pathlib.Path) -> pathlib.Path:
+    return column_png.with_name(column_png.stem + "-slips.csv")
+
+
+def save_slip_index(column_png: pathlib.Path):
+    """Write column-N-slips.csv beside column-N.png"""
+    with telemetry.stage(
+        "slip_index",
+        page=telemetry.page_of(column_png),
+        image=telemetry.name_of(column_png),
+    ):
+        index = slip_index(BinaryImage.open(column_png))
+        telemetry.note(slips=len(index))
+    index.to_csv(slips_path(column_png), index=False)
+    logger.info("{}: {} slips", column_png, len(index))
+
+
+@click.command()
+@click.argument(
+    "columns",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path),
+)
+def slips(columns):
+    """Find every address slip of each column image, writing their boxes to
+    column-N-slips.csv rather than an image per slip"""
+
+    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+
+    for column_png in columns:
+        save_slip_index(column_png)
+
+
+if __name__ == "__main__":
+    logger.remove()
+
+    slips()
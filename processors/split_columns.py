@@ -4,27 +4,56 @@ import sys
 
 import click
 from loguru import logger
-from PIL import Image
 from shapely.geometry import Polygon
 
-from image_utils import deskew
+import line_skew
+import page_transform
+import telemetry
+from image_utils import DESKEW_METHODS, ROTATE_BACKENDS, BinaryImage, deskew_angle
 from street_correct import find_five_columns
 
-
 logger.remove()
 
+# bump when the column images would come out differently
+STAGE_VERSION = 2
+
+
+def save_column(
+    im,
+    i,
+    column,
+    savepath,
+    deskew_method="rotate",
+    source=None,
+    angle=None,
+    deskew_backend="scipy",
+):
+    """Save this column
 
-def save_column(im, i, column, savepath):
-    """Save this column"""
+    angle is what to rotate it by, if it's already known; otherwise it's
+    found with deskew_method and deskew_backend. source is the image im was
+    cut from and the Transform that cut it, if we have them. The column is then cut straight out of the source in one
+    resample, instead of rotating the already rotated crop again. Returns
+    the column's Transform."""
 
     ftif = "column-%d.png" % (i + 1)
 
-    trimmed = im.crop(column.bounds)
-    # horizontal deskew
-    trimmed = deskew(trimmed, axis=0)
-    # trimmed = silly_crop(trimmed)
-    trimmed.save(savepath / ftif, "PNG")
-    return trimmed
+    with telemetry.stage("save_column", column=i + 1):
+        trimmed = im.crop(column.bounds)
+        telemetry.note(width=trimmed.size[0], height=trimmed.size[1])
+        # horizontal deskew
+        if angle is None:
+            angle = deskew_angle(
+                trimmed, axis=0, method=deskew_method, backend=deskew_backend
+            )
+        if source is None:
+            source = im, page_transform.Transform(im.size)
+        source_image, transform = source
+        transform = transform.copy().crop(column.bounds).rotate(angle)
+        trimmed = transform.apply(source_image)
+        # trimmed = silly_crop(trimmed)
+        trimmed.save(savepath / ftif, "PNG")
+        return transform
 
 
 def get_columns(bar_limits, im_size):
@@ -38,15 +67,11 @@ def get_columns(bar_limits, im_size):
     return cols
 
 
-@logger.catch
-@click.command()
-@click.argument("filename", type=click.Path(exists=True))
-def split_page(filename):
-    """Extract columns from spreadsheet-like image file"""
+def split_page_image(filename, deskew_method="rotate", deskew_backend="scipy"):
+    """Split the (hand)cropped page image into five column images
 
-    logger.add(
-        sys.stderr, format="<level>{message}</level>", backtrace=True, level="INFO"
-    )
+    Returns the paths of the saved columns, raises RuntimeError if the page
+    can't be split."""
 
     handcrop = pathlib.Path(filename).with_name("page-handcrop.png")
     if handcrop.exists():
@@ -55,21 +80,81 @@ def split_page(filename):
         )
         filename = handcrop
 
-    im = Image.open(filename)
-    try:
-        column_limits = find_five_columns(im)
-        clips = get_columns(column_limits, im.size)
-    except RuntimeError:
-        logger.critical("{}: can't split into columns", filename)
-        sys.exit(1)
-    # sys.stderr.write("%s: %d columns detected\n" % (filename, len(vlines)))
+    with telemetry.stage("split_page", page=telemetry.page_of(filename)):
+        im = BinaryImage.open(filename)
+        telemetry.note(width=im.size[0], height=im.size[1])
+        filename = pathlib.Path(filename)
+        if filename.name == "page-crop.png":
+            source_file, transform = page_transform.crop_transform(filename, im.size)
+        else:
+            # a handcrop is cut from nothing we know of
+            source_file, transform = filename, page_transform.Transform(im.size)
+        try:
+            column_limits = find_five_columns(im)
+            clips = get_columns(column_limits, im.size)
+        except RuntimeError:
+            raise RuntimeError("{}: can't split into columns".format(filename))
+        source = im if source_file == filename else BinaryImage.open(source_file)
+
+        angles = [None] * len(clips)
+        if deskew_method == "lines":
+            # each column straightened by the bars either side of it, all
+            # measured at once, instead of searching each column
+            try:
+                page_angle, residuals = line_skew.column_skew(im, limits=column_limits)
+                angles = [page_angle + x for x in residuals]
+            except RuntimeError as e:
+                logger.warning("{}: {}, deskewing the columns one by one", filename, e)
+        # sys.stderr.write("%s: %d columns detected\n" % (filename, len(vlines)))
+
+        # clips = get_columns(vlines, top_bar, im.size)
+        # sys.stderr.write("%s: cols: %d\n" % (filename, len(clips)))
+
+        savepath = filename.parent
+        transforms = [
+            save_column(
+                im,
+                i,
+                col,
+                savepath,
+                deskew_method,
+                (source, transform),
+                angle,
+                deskew_backend,
+            )
+            for i, (col, angle) in enumerate(zip(clips, angles))
+        ]
+        page_transform.record_columns(savepath, source_file, transforms)
+    return [savepath / ("column-%d.png" % (i + 1)) for i in range(len(clips))]
 
-    # clips = get_columns(vlines, top_bar, im.size)
-    # sys.stderr.write("%s: cols: %d\n" % (filename, len(clips)))
 
-    savepath = pathlib.Path(filename).parent
-    for i, col in enumerate(clips):
-        save_column(im, i, col, savepath)
+@logger.catch
+@click.command()
+@click.argument("filename", type=click.Path(exists=True))
+@click.option(
+    "--deskew-method",
+    type=click.Choice(DESKEW_METHODS),
+    default="rotate",
+    help="How to find deskew angles: rotate, projection or lines.",
+)
+@click.option(
+    "--deskew-backend",
+    type=click.Choice(sorted(ROTATE_BACKENDS)),
+    default="scipy",
+    help="What rotates each column while searching for its angle.",
+)
+def split_page(filename, deskew_method, deskew_backend):
+    """Extract columns from spreadsheet-like image file"""
+
+    logger.add(
+        sys.stderr, format="<level>{message}</level>", backtrace=True, level="INFO"
+    )
+
+    try:
+        split_page_image(filename, deskew_method, deskew_backend)
+    except RuntimeError as e:
+        logger.critical("{}", e)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
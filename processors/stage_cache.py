@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import pathlib
+
+CACHE_FILE = ".stage-cache.json"
+
+
+def file_digest(path: pathlib.Path) -> str:
+    """sha256 of the file's bytes, so touching or re-checking-out a file
+    doesn't make it look changed"""
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StageCache:
+    """Per-page record of the input hash that produced each stage's output
+
+    A stage's key covers its name, version, the bytes of every input file and
+    any settings that change its output. If the recorded key matches and the
+    outputs still exist, the stage doesn't need to run again."""
+
+    def __init__(self, page_dir: pathlib.Path):
+        self.path = page_dir / CACHE_FILE
+        try:
+            self.records = json.loads(self.path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.records = {}
+
+    @staticmethod
+    def key(stage: str, version: int, inputs, settings=None) -> str:
+        h = hashlib.sha256()
+        h.update(json.dumps([stage, version, settings], sort_keys=True).encode())
+        for path in inputs:
+            h.update(path.name.encode())
+            h.update(file_digest(path).encode())
+        return h.hexdigest()
+
+    def fresh(self, stage: str, key: str, outputs) -> bool:
+        return self.records.get(stage) == key and all(x.exists() for x in outputs)
+
+    def known(self, stage: str) -> bool:
+        return stage in self.records
+
+    def record(self, stage: str, key: str):
+        self.records[stage] = key
+        self.path.write_text(json.dumps(self.records, indent=1, sort_keys=True))
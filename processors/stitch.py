@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import csv
+import pathlib
+import sys
+
+import click
+from loguru import logger
+
+from ocr_column import COLUMNS, CONTINUED_STREET
+
+# how CONTINUED_STREET looks in the street field of a parsed csv,
+# with the page, column and line number fields before it
+PLACEHOLDER = ',"{}",'.format(CONTINUED_STREET)
+
+
+def quote(text: str) -> str:
+    """Quote a field the way the column csvs are written (QUOTE_NONNUMERIC)"""
+    return '"{}"'.format(text.replace('"', '""'))
+
+
+def read_rows(parsed: pathlib.Path):
+    """The header and the data lines of a parsed column csv, as written"""
+    with open(parsed, newline="") as fp:
+        lines = fp.read().splitlines(keepends=True)
+    return lines[:1], lines[1:]
+
+
+def street_of(line: str) -> str:
+    return next(csv.reader([line]))[3]
+
+
+def last_street(parsed: pathlib.Path):
+    """The street on the last row of a parsed column: None if it's empty,
+    CONTINUED_STREET if it's all one street that started before it"""
+    header, rows = read_rows(parsed)
+    if not rows:
+        return None
+    return street_of(rows[-1])
+
+
+def previous_page_dir(page_dir: pathlib.Path):
+    """working/012 -> working/011, if page 11 is there"""
+    if not page_dir.name.isdigit() or int(page_dir.name) == 0:
+        return None
+    previous = page_dir.with_name(
+        "{:0{}}".format(int(page_dir.name) - 1, len(page_dir.name))
+    )
+    return previous if previous.is_dir() else None
+
+
+def continued_street(page_dir: pathlib.Path, columns=COLUMNS):
+    """The street the previous page ends on, and so the street this page's
+    first column continues, going back a page at a time while whole pages
+    are one street.
+
+    A parsed column that ends with no addresses continues nothing, same as
+    when the columns were parsed one after another."""
+
+    previous = previous_page_dir(page_dir)
+    while previous is not None:
+        for i in reversed(columns):
+            parsed = previous / "column-{}-parsed.csv".format(i)
+            if not parsed.exists():
+                return None
+            street = last_street(parsed)
+            if street != CONTINUED_STREET:
+                return street
+        previous = previous_page_dir(previous)
+    return None
+
+
+def stitch_column(parsed: pathlib.Path, output: pathlib.Path, street):
+    """Write the parsed column out with its CONTINUED_STREET rows renamed to
+    street, or dropped if there's no street to continue.
+
+    Returns the street the next column continues."""
+
+    header, rows = read_rows(parsed)
+    stitched = []
+    for row in rows:
+        if street_of(row) != CONTINUED_STREET:
+            stitched.append(row)
+        elif street is not None:
+            # nothing before the street field can look like the placeholder
+            stitched.append(row.replace(PLACEHOLDER, ",{},".format(quote(street)), 1))
+    rows = stitched
+
+    with open(output, "w", newline="") as fp:
+        fp.writelines(header + rows)
+
+    if not rows:
+        return None
+    return street_of(rows[-1])
+
+
+def stitch_page(page_dir: pathlib.Path, street, columns=COLUMNS):
+    """Stitch a page's parsed columns into column-N-ocr.csv, the first one
+    continuing street. Returns the street the page ends on."""
+
+    for i in columns:
+        if street:
+            logger.info("{}: column {} continues {}", page_dir, i, street)
+        street = stitch_column(
+            page_dir / "column-{}-parsed.csv".format(i),
+            page_dir / "column-{}-ocr.csv".format(i),
+            street,
+        )
+    return street
+
+
+@click.command()
+@click.argument(
+    "page_dirs",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path),
+)
+def stitch(page_dirs):
+    """Fill in the street each parsed column continues from the column (or
+    page) before it, writing column-N-ocr.csv. Pages are stitched in order,
+    each continuing whatever its previous page's parsed columns end on."""
+
+    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+
+    previous = None
+    for page_dir in sorted(page_dirs):
+        if previous is None or previous_page_dir(page_dir) != previous:
+            street = continued_street(page_dir)
+        street = stitch_page(page_dir, street)
+        previous = page_dir
+
+
+if __name__ == "__main__":
+    logger.remove()
+
+    stitch()
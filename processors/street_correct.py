@@ -12,7 +12,9 @@ import peakutils
 from PIL import Image
 from shapely.geometry import Polygon
 
-from image_utils import deskew, get_histogram, new_crop
+import telemetry
+from image_utils import as_binary, deskew, get_histogram, new_crop
+from slip_index import centre_lines, halves, row_boxes, slip_index
 
 
 
@@ -37,87 +39,19 @@ def split_on_center_line(img):
 def v_any(subimg):
     "What percentage of the vertical rows has a black pixel?"
     wd, ht = subimg.size
-    pix = np.array(subimg.convert("1").getdata(), np.uint8)
-    bin_img = 1 - (pix.reshape((ht, wd)) / 255.0)
-    # print(np.any(bin_img, axis=1))
-    return np.sum(np.any(bin_img, axis=1)) / ht
+    bits = as_binary(subimg).bits
+    # print(np.any(bits, axis=1))
+    return np.count_nonzero(np.any(bits, axis=1)) / ht
 
 
 def divide_slip(img, thresh=5):
+    """The boxes either side of the line down the middle of a row, or the
+    whole row and None if there's no line"""
     wd, ht = img.size
-    full_img = (0, 0, wd, ht)
-
-    hist = get_histogram(img)
-    x = hist > thresh  # detect whitespace
-
-    # we're looking for a narrow, nearly-full height line
-    # near the middle of the cell
-
-    groups = [(len(list(j)), i) for i, j in groupby(x)]
-    group_info = []
-
-    # within 5% of the center of the cell
-    center = wd / 2
-    window = wd / 20
-
-    i = 0
-    for group, v in groups:
-        if v and (abs(i - center) < window):
-            # not whitespace and near the center
-            s = sum(hist[i : i + group])
-            # start, width, end, average value, % of a totally filled column
-            group_info.append((i, group, i + group, s / group, s / (group * ht)))
-        i += group
-
-    debug("group_info", group_info)
-
-    # middle_columns = [x for x in group_info if (abs(x[0]-center) < window)]
-    # debug('middle_columns',middle_columns)
-    middle_columns = group_info
-    if debug and middle_columns:
-        mc = middle_columns[0]
-        debug(hist[mc[0] : mc[0] + mc[1]])
-
-    if not middle_columns:
-        # nothing in the middle, abort
-        return full_img, None
-    slip_any = hist.max() / ht
-
-    filled_columns = []
-    for form in middle_columns:
-        subimg = img.crop((form[0], 0, form[2], ht))
-        # return v_any(subimg)
-        if v_any(subimg) / slip_any > 0.78 and form[1] <= 12:
-            # at least 78% of a filled line, relative to the slip content
-            # and 12 pixels wide
-            filled_columns.append(form)
-
-    # filled_columns = [x for x in middle_columns if (x[4] >= .5 and x[1] <= 12)]
-    debug(center - wd / 40, center + wd / 40, wd, ht)
-    debug("filled_columns", filled_columns)
-    if not filled_columns:
-        # print("no line!", group_info)
-        # we found no line
-        return full_img, None
-    elif len(filled_columns) > 1:
-        sys.stderr.write(
-            "warning, more than one possible center line detected, choosing thiccest\n"
-        )
-        m = max((x[4] for x in filled_columns))
-        filled_columns = [x for x in filled_columns if x[4] == m]
-        # print(group_info)
-        # print(center-wd/20, center+wd/20)
-        # return full_img, None
-
-    center_line = filled_columns[0]
-    left, right = center_line[0], center_line[2]
-    if center_line[1] > 15:  # too wide?!?
-        # print("line too wide!")
-        return full_img, None
-    # split it
-    a = (0, 0, left - 1, ht)
-    b = (right + 1, 0, wd, ht)
-    return a, b
+    box = (0, 0, wd, ht)
+    line = centre_lines(as_binary(img), [box], thresh)[0]
+    a, *b = halves(box, line)
+    return a, b[0] if b else None
 
 
 def find_five_columns(img):
@@ -126,44 +60,46 @@ def find_five_columns(img):
 
     """
     image_width, image_height = img.size
-
-    # top_line = find_top_line(img)
-
-    # find the thick vertical lines
-    hist = get_histogram(img, axis=0)
-    if DEBUG and False:
-        plt.plot(hist)
-        plt.show()
-    indexes = peakutils.indexes(
-        hist, thres=0.75, min_dist=image_width / 7
-    )  # , min_dist=5)
-    debug([(i, hist[i]) for i in indexes])
-
-    x = indexes - np.roll(indexes, 1)
-    x[0] = 0
-    x = np.append(x, 0)
-
-    median_column_width = np.median(x[1:-1])  # find median width of a column
-    q = abs(1 - x / median_column_width) < 0.02  # within 2% of median width is good
-
-    proper_indexes = [indexes[i] for i in range(len(indexes)) if q[i] or q[i + 1]]
-
-    # let's say that a line is a 66% filled column within 5% of the center
-    # of the cell
-    debug("right distance apart:", proper_indexes)
-
-    if len(proper_indexes) != 4:
-          # if not four bars, we have a problem
-        raise RuntimeError("can't split into 5 columns")
-
-    prev_i = 0
-    bar_limits = []  # [0] + proper_indexes + [image_width]
-    for i in proper_indexes:
-        bar_limits.append((prev_i, i))
-        prev_i = i
-    bar_limits.append((prev_i, image_width))
-    debug(bar_limits)
-    return bar_limits
+    with telemetry.stage("find_five_columns", width=image_width, height=image_height):
+        # top_line = find_top_line(img)
+
+        # find the thick vertical lines
+        hist = get_histogram(img, axis=0)
+        if DEBUG and False:
+            plt.plot(hist)
+            plt.show()
+        indexes = peakutils.indexes(
+            hist, thres=0.75, min_dist=image_width / 7
+        )  # , min_dist=5)
+        debug([(i, hist[i]) for i in indexes])
+        telemetry.note(peaks=len(indexes))
+
+        x = indexes - np.roll(indexes, 1)
+        x[0] = 0
+        x = np.append(x, 0)
+
+        median_column_width = np.median(x[1:-1])  # find median width of a column
+        q = abs(1 - x / median_column_width) < 0.02  # within 2% of median width is good
+
+        proper_indexes = [indexes[i] for i in range(len(indexes)) if q[i] or q[i + 1]]
+        telemetry.note(bars=len(proper_indexes))
+
+        # let's say that a line is a 66% filled column within 5% of the center
+        # of the cell
+        debug("right distance apart:", proper_indexes)
+
+        if len(proper_indexes) != 4:
+            # if not four bars, we have a problem
+            raise RuntimeError("can't split into 5 columns")
+
+        prev_i = 0
+        bar_limits = []  # [0] + proper_indexes + [image_width]
+        for i in proper_indexes:
+            bar_limits.append((prev_i, i))
+            prev_i = i
+        bar_limits.append((prev_i, image_width))
+        debug(bar_limits)
+        return bar_limits
 
 
 def x_find_five_columns(img):
@@ -305,118 +241,19 @@ def split_into_rows(img, threshold=10):
 
 def divide_into_rows(img, threshold=10):
     """generator that yields the bounding box of each row"""
-    image_width, ht = img.size
-
-    hist = get_histogram(img, axis=1)
-
-    x = hist > threshold  # threshold is around 10
-
-    groups = [[len(list(j)), i] for i, j in groupby(x)]
-
-    debug(groups)
-
-    save_whitespace = False
-
-    # we can split the whitespace between two adjacent rows, or just discard it
-    if save_whitespace:
-        g = [groups[0][:]]
-
-        i = 1
-        while i < len(groups):
-            # given x[i-1], x[i], x[i+1], split whitespace x[i] between the two
-            group, group_has_black = groups[i]
-
-            if not group_has_black:  # whitespace
-                if i + 2 < len(groups):  # not close to end
-                    g[-1][0] += group / 2
-                    g[-1][0] += group - (group / 2)
-                    i += 1
-                    continue
-
-            g.append([group, group_has_black])
-            i += 1
-
-        groups = g
-    # else:
-    #    groups = [g for g in groups if g[1]] # just the stuff with content
-
-    # the median width of a detected row ought to be the average width of an address row
-    median = np.median(np.array([g for g, x in groups]))
-
-    def multiple_rows(group):
-        # is this likely a run of multiple rows?
-        slips = group / median
-        remainder = group % median
-        slop = min(median - remainder, remainder)  # how close are we
-        # print(group, median, remainder, slop)
-        if slop < median * 0.05:
-            return True
-        else:
-            return False
-
-    j = 0
-    row = 0
-    for group, v in groups:
-        # address slips are about 40-50 pixels
-        # print (group, median)
-        if not v:  # whitespace
-            debug("ws", group)
-            pass
-        elif group < 17:  # skip rows that are short
-            debug("short", group)
-            pass
-        elif group > median * 1.1 and multiple_rows(
-            group
-        ):  # this is too long to be a single row
-            step = group / round(group / median)
-            debug(
-                "splitting",
-                j,
-                group,
-                "into",
-                int(round(group / median)),
-                "slips of ",
-                step,
-            )
-            for i in range(int(round(group / median))):
-                # print("split", i,step*i)
-                yield (0, row + step * i, image_width, row + step * (i + 1))
-                j += 1
-        else:
-            debug(j, "whole", row, group)
-            slip = (0, row, image_width, row + group)
-            # slip = remove_center_line(slip)
-
-            yield slip
-            j += 1
-
-        row += group
+    yield from row_boxes(as_binary(img), threshold)
 
 
 def split_and_save_column(im, i, column, fbase):
-    """Save OCRed text from this column"""
+    """Save this column, and the boxes of its address slips"""
 
     ftif = "%s-%d" % (fbase, i)
 
-    # cmd = "tesseract -psm 4 %s %s" % (ftif, fbase) # assume vertical alignment, no columns
-
-    width, height = im.size
-
     trimmed = im.crop(column.bounds)
     trimmed.save(ftif + ".png", "PNG")
 
-    row_slice = "%s-%02d-%d.png"
-
-    for row, row_img in enumerate(split_into_rows(trimmed)):
-        # print(row, row_img.size)
-        if row_img.size[1] <= 10:
-            # too narrow to be a real rows
-            continue
-        l, r = split_on_center_line(row_img)
-        if l:
-            auto_crop(l).save(row_slice % (ftif, row, 0), "PNG")
-        if r:
-            auto_crop(r).save(row_slice % (ftif, row, 1), "PNG")
+    # one csv of boxes, rather than an image for each half of each row
+    slip_index(trimmed).to_csv(ftif + "-slips.csv", index=False)
 
 
 def load_image(filename):
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import contextlib
+import json
+import os
+import pathlib
+import resource
+import sys
+import threading
+import time
+import uuid
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import config
+
+# the stages open in this process, innermost last
+_open = []
+
+# some stages count from several threads at once
+_count_lock = threading.Lock()
+
+
+def sink():
+    """The telemetry file, or None if telemetry is off"""
+    path = os.environ.get("TELEMETRY", str(config.TELEMETRY_FILE))
+    return pathlib.Path(path) if path else None
+
+
+def configure(enabled=True, run=None):
+    """Turn telemetry on or off, and tag the records with a run, for this
+    process and the workers it starts from now on"""
+    if not enabled:
+        os.environ["TELEMETRY"] = ""
+    if run is not None:
+        os.environ["TELEMETRY_RUN"] = run
+
+
+def page_of(path):
+    """working/012/column-1.png -> "012", None for anything that isn't a path"""
+    if isinstance(path, (str, pathlib.Path)):
+        return pathlib.Path(path).parent.name
+    return None
+
+
+def name_of(path):
+    """working/012/column-1.png -> "column-1.png", None for anything that isn't a path"""
+    if isinstance(path, (str, pathlib.Path)):
+        return pathlib.Path(path).name
+    return None
+
+
+def peak_rss_mb() -> float:
+    """The most memory this process has held at any one time, so far.
+
+    That's the whole process's high-water mark, not the stage's: a long-lived
+    pool worker reports the peak of whatever it ran before, too."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+def count(name, n=1):
+    """Add n to a counter of the innermost open stage"""
+    with _count_lock:
+        if _open:
+            _open[-1][name] = _open[-1].get(name, 0) + n
+
+
+def note(**fields):
+    """Set fields (sizes, results) on the innermost open stage"""
+    if _open:
+        _open[-1].update(fields)
+
+
+@contextlib.contextmanager
+def stage(name, page=None, **fields):
+    """Time the enclosed block as one stage, appending a json line for it to
+    the telemetry file. Stages opened inside it record it as their parent,
+    and take its page unless they're given one.
+
+    Yields the record, which count() and note() add to."""
+
+    parent = _open[-1] if _open else None
+    if page is None and parent is not None:
+        page = parent["page"]
+    record = {
+        "stage": name,
+        "page": page,
+        "id": uuid.uuid4().hex[:16],
+        "parent": parent["id"] if parent else None,
+        "run": os.environ.get("TELEMETRY_RUN"),
+        "ts": time.time(),
+    }
+    record.update(fields)
+
+    _open.append(record)
+    wall, cpu = time.perf_counter(), time.process_time()
+    peak = peak_rss_mb()
+    ok = False
+    try:
+        yield record
+        ok = True
+    finally:
+        _open.remove(record)
+        record["wall"] = time.perf_counter() - wall
+        record["cpu"] = time.process_time() - cpu
+        record["peak_rss_mb"] = peak_rss_mb()
+        # how far this stage raised the process's high-water mark
+        record["rss_growth_mb"] = record["peak_rss_mb"] - peak
+        record["ok"] = ok
+        emit(record)
+
+
+def emit(record):
+    path = sink()
+    if path is None:
+        return
+    try:
+        # one write of one short line, so lines from processes appending at
+        # the same time don't interleave
+        with open(path, "a") as fp:
+            fp.write(json.dumps(record, default=str) + "\n")
+    except OSError:
+        # telemetry is never a reason for a stage to fail
+        pass
+
+
+def read_records(path=None) -> list:
+    """Every record in the telemetry file"""
+    path = path or sink()
+    records = []
+    try:
+        with open(path) as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # a line cut short by a killed process
+                    continue
+    except (FileNotFoundError, TypeError):
+        pass
+    return records
+
+
+def stage_key(record):
+    # some stages run once per column, or per image
+    return (
+        record["page"],
+        record["stage"],
+        record.get("column"),
+        record.get("image"),
+    )
+
+
+def latest(records) -> list:
+    """The most recent record of each top-level stage of each page, and all
+    the stages that ran inside those.
+
+    A stage that was run on its own (say, by make) and has since run again
+    inside a pipeline's process_page only counts the once."""
+
+    children = {}
+    for record in records:
+        if record["parent"] is not None:
+            children.setdefault(record["parent"], []).append(record)
+
+    def descendants(record):
+        for child in children.get(record["id"], []):
+            yield child
+            yield from descendants(child)
+
+    tops = {}
+    for record in records:
+        if record["parent"] is None and record["page"] is not None:
+            key = stage_key(record)
+            if key not in tops or record["ts"] > tops[key]["ts"]:
+                tops[key] = record
+
+    # when each stage inside a top-level stage last ran that way
+    nested = {}
+    for top in tops.values():
+        for record in descendants(top):
+            key = stage_key(record)
+            nested[key] = max(nested.get(key, 0), top["ts"])
+
+    kept = []
+    for key, top in tops.items():
+        if nested.get(key, 0) > top["ts"]:
+            continue
+        kept.append(top)
+        kept.extend(descendants(top))
+    return sorted(kept, key=lambda x: x["ts"])
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import numpy as np
+import pandas as pd
+
+# the columns of a column-N-raw_ocr.csv word table, in order, with their types:
+# tesseract's tsv columns plus the right and bottom edges of each box
+WORD_COLUMNS = {
+    "level": "i4",
+    "page_num": "i4",
+    "block_num": "i4",
+    "par_num": "i4",
+    "line_num": "i4",
+    "word_num": "i4",
+    "left": "i4",
+    "top": "i4",
+    "width": "i4",
+    "height": "i4",
+    "conf": "f8",
+    "text": "O",
+    "right": "i4",
+    "bot": "i4",
+}
+
+# what the column parser needs of each word
+TEXT_DTYPE = np.dtype(
+    [
+        ("text", "O"),
+        ("line_num", "i4"),
+        ("conf", "f8"),
+        ("top", "i4"),
+        ("left", "i4"),
+        ("right", "i4"),
+        ("bot", "i4"),
+        ("height", "i4"),
+    ]
+)
+
+
+# the same, as pandas dtypes: the text is always a string,
+# even if every word on the column is a number
+FRAME_DTYPES = {
+    name: str if dtype == "O" else dtype for name, dtype in WORD_COLUMNS.items()
+}
+
+
+def word_frame(ocr_data: pd.DataFrame) -> pd.DataFrame:
+    """Put an OCR word table into the raw_ocr column order and types"""
+    return ocr_data[list(WORD_COLUMNS)].astype(FRAME_DTYPES)
+
+
+def read_raw_ocr(filename) -> pd.DataFrame:
+    """Read a column-N-raw_ocr.csv with its columns typed"""
+    return pd.read_csv(filename, dtype=FRAME_DTYPES)
+
+
+class WordTable:
+    """The words of a column as one typed record array.
+
+    Rows are handed out as Text objects only when they're needed,
+    rather than keeping a pandas row or a dict per word."""
+
+    __slots__ = ("words",)
+
+    def __init__(self, words: np.ndarray):
+        self.words = words
+
+    @classmethod
+    def from_frame(cls, ocr_data: pd.DataFrame) -> "WordTable":
+        words = np.empty(len(ocr_data), dtype=TEXT_DTYPE)
+        for name in TEXT_DTYPE.names:
+            words[name] = ocr_data[name].to_numpy()
+        return cls(words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def texts(self, positions) -> list:
+        """Text views of the words at these positions"""
+        # the height is last, and isn't part of the Text
+        return [Text(*word[:-1]) for word in self.words[positions].tolist()]
+
+    def height(self, positions) -> int:
+        return int(self.words["height"][positions].min())
+
+
+class Text:
+    """One word (or a few joined words) of a row, and its box"""
+
+    __slots__ = ("text", "line_num", "conf", "top", "left", "right", "bot", "flag")
+
+    def __init__(self, text, line_num, conf, top, left, right, bot):
+        self.text = text
+        self.line_num = line_num
+        self.conf = conf
+        self.top = top
+        self.left = left
+        self.right = right
+        self.bot = bot
+        self.flag = False
+
+    @property
+    def bbox(self):
+        return (self.left, self.top, self.right, self.bot)
+
+    def __repr__(self):
+        return "<{!r} ({})>".format(self.text, self.conf)
+
+    def __add__(self, other):
+        return Text(
+            self.text + " " + other.text,
+            self.line_num,
+            min(self.conf, other.conf),
+            max(self.top, other.top),
+            min(self.left, other.left),
+            max(self.right, other.right),
+            min(self.bot, other.bot),
+        )
+
+    def split(self):
+        "split this if it has a |"
+        if "|" not in self.text:
+            return [self]
+        texts = []
+        for subtext in self.text.split("|"):
+            if subtext:
+                new_text = Text(
+                    subtext,
+                    self.line_num,
+                    self.conf,
+                    self.top,
+                    self.left,
+                    self.right,
+                    self.bot,
+                )
+                new_text.flag = self.flag
+                texts.append(new_text)
+        return texts